@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import asyncore
+import time
+import timers
+
+class Transport (asyncore.dispatcher):
+	"""asyncore channel driving one connection's reader and writer"""
+	def __init__ (self, sock, reader, writer, socket_map):
+		asyncore.dispatcher.__init__(self, sock, socket_map)
+		self.reader = reader
+		self.writer = writer
+		self.want_write = False
+
+	def readable (self):
+		return True
+
+	def writable (self):
+		return self.want_write and self.writer is not None
+
+	# the connection objects do their own reads, writes and error
+	# handling, so every event is handed straight back to them
+	def handle_read_event (self):
+		self.reader()
+
+	def handle_expt_event (self):
+		self.reader()
+
+	def handle_close (self):
+		self.reader()
+
+	def handle_write_event (self):
+		self.writer()
+
+	def handle_error (self):
+		raise
+
+class AsyncoreLoop ():
+	"""the EventLoop interface on top of asyncore, so the two runtimes can
+	be compared against each other with the same handlers"""
+	def __init__ (self, logger):
+		self.logger = logger
+		self.map = {}
+		self.transports = {}
+		# when the last wait ended, for timing the work that followed it
+		self.woke = time.time()
+		self.timers = timers.TimerWheel()
+		self.backend = "asyncore"
+		self.logger.log("DEBUG", "event loop using asyncore")
+
+	def call_later (self, delay, callback, *args):
+		"""runs callback(*args) from the loop after delay seconds; returns a
+		timer that can be cancelled"""
+		return self.timers.call_later(delay, callback, *args)
+
+	def register (self, sock, reader, writer = None):
+		"""starts watching sock for readability"""
+		self.transports[sock] = Transport(sock, reader, writer, self.map)
+
+	def unregister (self, sock):
+		"""stops watching sock; must be called before the socket is closed"""
+		transport = self.transports.pop(sock, None)
+		if transport:
+			transport.del_channel(self.map)
+
+	def set_writable (self, sock, enabled):
+		"""turns write interest for sock on or off"""
+		transport = self.transports.get(sock)
+		if transport:
+			transport.want_write = enabled
+
+	def run_once (self, timeout = None):
+		"""waits up to timeout seconds (or until the next timer is due),
+		dispatches every ready socket and then runs the due timers"""
+		wait = self.timers.timeout(time.time())
+		if wait is not None and (timeout is None or wait < timeout):
+			timeout = wait
+		if timeout is not None:
+			timeout = timers.round_up(timeout)
+		asyncore.loop(timeout, True, self.map, 1)
+		self.woke = time.time()
+		self.timers.run(time.time())
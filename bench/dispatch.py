@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""per-line parse and dispatch cost: the old split-and-scan handle_line
+against message.parse and the LocalConnection.commands table"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+ os.pardir))
+
+import connections
+import message
+
+LINES = [
+	"PRIVMSG #channel :hello there, how is everyone doing today?",
+	"NOTICE somenick :a notice with a few words in it",
+	"MODE #channel +o somenick",
+	"JOIN #channel",
+	"PING :irc.example.net",
+	"KICK #channel somenick :go away",
+	"WHOIS somenick",
+	"PONG :irc.example.net",
+]
+
+# the table handle_line used to rebuild for every line
+LEGACY = (
+	("USER", 4, True), ("NICK", 1, True), ("AWAY", 0), ("PRIVMSG", 2),
+	("NOTICE", 2), ("TOPIC", 1), ("INVITE", 2), ("JOIN", 1), ("PART", 1),
+	("MOTD", 0, True), ("PING", 1), ("QUIT", 0, True), ("KICK", 2),
+	("OPER", 2), ("DIE", 0), ("WHO", 1), ("WHOIS", 1), ("NAMES", 1),
+	("LINKS", 0), ("MODE", 1), ("KILL", 2), ("PONG", 0, True),
+	("CAP", 0, True),
+)
+
+def handler (args):
+	pass
+
+def legacy_callback (command, line, min_args, cb, pre_register = False):
+	if command != line[0].upper():
+		return False
+	if len(line) < min_args + 1:
+		return True
+	args = line
+	for i in xrange(len(line)):
+		if line[i].startswith(":"):
+			args = line[:i] + [" ".join(line[i:])[1:]]
+			break
+	cb(args)
+	return True
+
+def legacy (line):
+	line = line.split(" ")
+	for i in tuple((e[0], e[1], handler) + e[2:] for e in LEGACY):
+		if legacy_callback(i[0], line, i[1], i[2],
+		 i[3] if len(i) > 3 else False):
+			break
+
+def current (line, commands = connections.LocalConnection.commands):
+	msg = message.parse(line)
+	entry = commands.get(msg.command)
+	if entry and len(msg.args) >= entry[0] + 1:
+		handler(msg.args)
+
+def main ():
+	rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	for name, fn in (("before", legacy), ("after", current)):
+		seconds = min(timeit.repeat(lambda: [fn(l) for l in LINES],
+		 number = rounds, repeat = 3))
+		print "%-6s %7.2f us/line" % (name,
+		 seconds / (rounds * len(LINES)) * 1e6)
+
+if __name__ == "__main__":
+	main()
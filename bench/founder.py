@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""checks that joining a channel the network already has makes nobody its
+founder, whichever worker the client is on
+
+starts prc.py with --workers processes and a stand-in PRC peer that
+routes by interest (CAPAB WANT) and has a user in #owned, then has
+clients, spread over the workers by the kernel, join it: none of them
+may be shown with the founder prefix in NAMES, nor may the peer see a
+MODE +a for them. once everyone has left and the peer no longer wants
+the channel, the next client to join founds it as usual
+
+	python bench/founder.py example --clients 8 --workers 2"""
+
+import argparse
+import sys
+import time
+
+from load import Bench, Client, Endpoint, Gateway, raise_fd_limit
+
+import config
+import log
+
+CHANNEL = "#owned"
+
+class Member (Client):
+	"""a client that keeps the NAMES replies it gets"""
+	def __init__ (self, bench, address, index):
+		Client.__init__(self, bench, address, index)
+		self.names = None
+
+	def handle (self, line, now):
+		Client.handle(self, line, now)
+		if " 353 %s " % self.nick in line:
+			self.names = line.rpartition(" :")[2].split()
+
+	def join (self, bench, timeout):
+		self.names = None
+		self.send("JOIN %s" % CHANNEL)
+		deadline = time.time() + timeout
+		while self.names is None and time.time() < deadline:
+			bench.poll(0.05)
+		return self.names
+
+class Owner (Endpoint):
+	"""the peer gateway, whose user has been in the channel all along"""
+	def __init__ (self, bench, address):
+		Endpoint.__init__(self, bench, address, "\n")
+		self.ready = True
+		self.modes = []
+		self.send("CAPAB :BURST MSGID WANT")
+		self.send("SERVER * owner.invalid 16700 :founder check peer")
+		self.send(":owner!owner@owner.invalid USER * * * :channel owner")
+		self.send("WANT %s" % CHANNEL)
+
+	def handle (self, line, now):
+		if " MODE %s +a " % CHANNEL in line:
+			self.modes.append(line)
+		elif line.startswith("WANT "):
+			# what a gateway answers with: its side of the channel
+			self.send("BC %s + :!owner" % CHANNEL)
+
+def run (options):
+	raise_fd_limit()
+	logger = log.logger("NONE")
+	conf = config.Main(options.config, logger)
+	local = conf.LOCAL_BIND[0]
+	remote = conf.REMOTE_BIND
+	if local[0] == "0.0.0.0":
+		local = ("127.0.0.1", local[1])
+	if remote[0] == "0.0.0.0":
+		remote = ("127.0.0.1", remote[1])
+
+	gateway = Gateway(options.config, options.python,
+	 ["WORKERS %d" % options.workers])
+	time.sleep(options.startup)
+	bench = Bench()
+	failures = []
+	try:
+		owner = Owner(bench, remote)
+		members = [Member(bench, local, i) for i in xrange(options.clients)]
+		bench.pump(options.pause)
+		for member in members:
+			names = member.join(bench, options.timeout)
+			if names is None:
+				failures.append("%s got no NAMES" % member.nick)
+			elif "!" + member.nick in names:
+				failures.append("%s founded %s: %s" % (member.nick, CHANNEL,
+				 " ".join(names)))
+		bench.pump(options.pause)
+		failures.extend("the peer saw %s" % line for line in owner.modes)
+
+		for member in members:
+			member.send("PART %s" % CHANNEL)
+		owner.send("UNWANT %s" % CHANNEL)
+		bench.pump(options.pause)
+		names = members[0].join(bench, options.timeout)
+		if not names or "!" + members[0].nick not in names:
+			failures.append("%s did not found the channel left empty: %s" % (
+			 members[0].nick, " ".join(names or ())))
+	finally:
+		gateway.stop()
+
+	for failure in failures:
+		print failure
+	print "%d clients over %d workers: %s" % (options.clients,
+	 options.workers, "failed" if failures else "ok")
+	return not failures
+
+def main ():
+	parser = argparse.ArgumentParser(description = __doc__.split("\n")[0])
+	parser.add_argument("config", help = "config file name in config/")
+	parser.add_argument("--clients", type = int, default = 8)
+	parser.add_argument("--workers", type = int, default = 2)
+	parser.add_argument("--pause", type = float, default = 0.5,
+	 help = "seconds to let JOINs, PARTs and WANTs go through")
+	parser.add_argument("--startup", type = float, default = 1,
+	 help = "seconds to give prc.py to start")
+	parser.add_argument("--timeout", type = float, default = 10)
+	parser.add_argument("--python", default = sys.executable,
+	 help = "interpreter to run prc.py with")
+	options = parser.parse_args()
+	sys.exit(0 if run(options) else 1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""connects and disconnects clients in rounds and checks the gateway
+gives the memory back
+
+every round a batch of clients registers and joins channels, one of
+them shared with a watcher that stays connected, then half of them QUIT and the rest just
+close their socket; a stand-in PRC peer introduces users into the same
+channels and drops its link. after each round, from the first one on,
+the watcher's STATS g has to show the user and channel counts back where
+they started, and its STATS o the connection, user and channel objects
+still alive. the gateway runs with GC_THRESHOLD 0, so the cyclic
+collector never frees anything: an object kept alive by a reference
+cycle counts as a leak (an --attach'ed gateway needs that setting too).
+the resident set is only reported
+
+	python bench/leak.py example --clients 100000 --batch 1000"""
+
+import argparse
+import sys
+import time
+
+from load import Bench, Client, Gateway, Peer, memory_kb, raise_fd_limit
+
+import config
+import log
+
+class Watcher (Client):
+	"""the oper who stays in the first channel and reads STATS g"""
+	def __init__ (self, bench, address, oper):
+		Client.__init__(self, bench, address, 0)
+		self.nick = "watcher"
+		self.send("NICK watcher")
+		self.send("OPER %s %s" % oper)
+		self.counts = None
+		self.live = None
+		self.objects = None
+
+	def handle (self, line, now):
+		Client.handle(self, line, now)
+		if " :users " in line:
+			words = line.split(" :users ", 1)[1].replace(",", "").split()
+			# users N (L local) channels C servers S
+			self.counts = (int(words[0]), int(words[4]))
+		elif " 249 watcher o :" in line:
+			# one class and how many of it are alive per line
+			name, count = line.split(" o :", 1)[1].split()
+			self.live[name] = int(count)
+		elif " 219 watcher o " in line:
+			self.objects = self.live
+
+	def stats (self, bench, timeout):
+		self.counts = None
+		self.send("STATS g")
+		deadline = time.time() + timeout
+		while self.counts is None and time.time() < deadline:
+			bench.poll(0.05)
+		return self.counts
+
+	def stats_objects (self, bench, timeout):
+		self.live = {}
+		self.objects = None
+		self.send("STATS o")
+		deadline = time.time() + timeout
+		while self.objects is None and time.time() < deadline:
+			bench.poll(0.05)
+		return self.objects
+
+def describe (objects):
+	if objects is None:
+		return "unknown"
+	return ", ".join("%s %d" % item for item in sorted(objects.iteritems()))
+
+def settle (bench, test, timeout):
+	deadline = time.time() + timeout
+	while not test():
+		if time.time() > deadline:
+			return False
+		bench.poll(0.05)
+	return True
+
+def cycle (bench, local, remote, options, index):
+	channels = ["#leak%d" % i for i in xrange(options.channels)]
+	first = bench.registered
+	clients = [Client(bench, local, index * options.batch + i + 1)
+	 for i in xrange(options.batch)]
+	peer = Peer(bench, remote, index, options.peer_users)
+	if not settle(bench, lambda: bench.registered - first == len(clients),
+	 options.timeout):
+		raise SystemExit("round %d: only %d of %d clients registered" %
+		 (index, bench.registered - first, len(clients)))
+	for i, client in enumerate(clients):
+		client.send("JOIN %s" % channels[i % len(channels)])
+		client.send("PRIVMSG %s :round %d" % (channels[i % len(channels)],
+		 index))
+	for i, nick in enumerate(peer.users):
+		peer.join(nick, channels[i % len(channels)])
+	bench.pump(options.pause)
+	for i, endpoint in enumerate(clients + [peer]):
+		if i % 2 and endpoint is not peer:
+			endpoint.send("QUIT :round %d" % index)
+			endpoint.flush()
+	bench.pump(options.pause)
+	for endpoint in clients + [peer]:
+		if not endpoint.closed:
+			bench.drop(endpoint)
+
+def run (options):
+	raise_fd_limit()
+	logger = log.logger("NONE")
+	conf = config.Main(options.config, logger)
+	if not conf.OPERATOR:
+		raise SystemExit("the config needs an OPERATOR for STATS")
+	local = conf.LOCAL_BIND[0]
+	remote = conf.REMOTE_BIND
+	if local[0] == "0.0.0.0":
+		local = ("127.0.0.1", local[1])
+	if remote[0] == "0.0.0.0":
+		remote = ("127.0.0.1", remote[1])
+
+	gateway = None
+	if not options.attach:
+		gateway = Gateway(options.config, options.python,
+		 ["GC_THRESHOLD 0"])
+		time.sleep(options.startup)
+	pid = gateway.pid if gateway else options.pid
+
+	bench = Bench()
+	failures = []
+	try:
+		watcher = Watcher(bench, local, conf.OPERATOR.items()[0])
+		settle(bench, lambda: watcher.ready, options.timeout)
+		watcher.send("JOIN #leak0")
+		bench.pump(options.pause)
+		baseline = watcher.stats(bench, options.timeout)
+		objects = watcher.stats_objects(bench, options.timeout)
+		print "baseline: %d users, %d channels; objects %s" % (baseline +
+		 (describe(objects),))
+
+		rounds = max(1, options.clients / options.batch)
+		for i in xrange(rounds):
+			cycle(bench, local, remote, options, i)
+			counts = None
+			deadline = time.time() + options.timeout
+			while counts != baseline and time.time() < deadline:
+				counts = watcher.stats(bench, options.timeout)
+			live = watcher.stats_objects(bench, options.timeout)
+			rss = memory_kb(pid)[0] if pid else None
+			if watcher.closed:
+				raise SystemExit("round %d: the watcher was disconnected" % i)
+			if counts != baseline:
+				failures.append("round %d: %s users, %s channels left over" % (
+				 i, counts[0] if counts else "?", counts[1] if counts else "?"))
+			if live != objects:
+				failures.append("round %d: objects %s, expected %s" % (i,
+				 describe(live), describe(objects)))
+			print "round %d: %d clients in total, rss %s kB" % (i,
+			 (i + 1) * options.batch, rss)
+	finally:
+		if gateway:
+			gateway.stop()
+
+	for failure in failures:
+		print failure
+	return not failures
+
+def main ():
+	parser = argparse.ArgumentParser(description = __doc__.split("\n")[0])
+	parser.add_argument("config", help = "config file name in config/")
+	parser.add_argument("--clients", type = int, default = 100000)
+	parser.add_argument("--batch", type = int, default = 1000,
+	 help = "clients connected at once in each round")
+	parser.add_argument("--peer-users", type = int, default = 100,
+	 help = "users the stand-in peer introduces each round")
+	parser.add_argument("--channels", type = int, default = 10)
+	parser.add_argument("--pause", type = float, default = 0.3,
+	 help = "seconds to let JOINs, and then QUITs, go through")
+	parser.add_argument("--startup", type = float, default = 1,
+	 help = "seconds to give prc.py to start")
+	parser.add_argument("--timeout", type = float, default = 60)
+	parser.add_argument("--attach", action = "store_true",
+	 help = "use a gateway that is already running")
+	parser.add_argument("--pid", type = int,
+	 help = "pid of that gateway, for RSS numbers")
+	parser.add_argument("--python", default = sys.executable,
+	 help = "interpreter to run prc.py with")
+	options = parser.parse_args()
+	sys.exit(0 if run(options) else 1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+"""synthetic load against a gateway
+
+starts prc.py with a config from config/ (or uses one that is already
+running), connects simulated IRC clients and stand-in PRC peer links,
+has them join channels and send PRIVMSG/NICK/MODE/WHO traffic at a
+target rate, and reports throughput, fanout latency percentiles and the
+gateway's CPU and memory use. every channel PRIVMSG carries its send
+time, so each delivery to another client or peer is one latency sample.
+
+	python bench/load.py example --clients 2000 --rate 2000 --json out.json"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import select
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from errno import EAGAIN, EINPROGRESS, EWOULDBLOCK
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+import config
+import log
+
+MARK = "bench"
+
+class Endpoint ():
+	"""one socket of the load generator, with line framing both ways"""
+	def __init__ (self, bench, address, ending):
+		self.bench = bench
+		self.ending = ending
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setblocking(0)
+		err = self.sock.connect_ex(address)
+		if err not in (0, EINPROGRESS, EWOULDBLOCK):
+			raise socket.error, os.strerror(err)
+		self.inbuf = ""
+		self.out = deque()
+		self.ready = False
+		self.closed = False
+		bench.add(self)
+
+	def send (self, line):
+		if self.closed:
+			return
+		if not self.out:
+			self.bench.want_write(self, True)
+		self.out.append(line + self.ending)
+
+	def flush (self):
+		data = "".join(self.out)
+		self.out.clear()
+		try:
+			sent = self.sock.send(data)
+		except socket.error as e:
+			if e.errno not in (EAGAIN, EWOULDBLOCK):
+				raise
+			sent = 0
+		if sent < len(data):
+			self.out.append(data[sent:])
+		else:
+			self.bench.want_write(self, False)
+
+	def read (self):
+		data = self.sock.recv(65536)
+		if not data:
+			raise socket.error, "closed by the gateway"
+		lines = (self.inbuf + data).replace("\r", "").split("\n")
+		self.inbuf = lines.pop()
+		now = time.time()
+		for line in lines:
+			if line:
+				self.handle(line, now)
+
+	def delivery (self, line, now):
+		"""records the latency of a bench PRIVMSG, if line is one"""
+		text = line.rpartition(" :%s " % MARK)[2]
+		if text != line:
+			self.bench.deliver(now - float(text.split()[0]))
+
+class Client (Endpoint):
+	"""a simulated IRC client"""
+	def __init__ (self, bench, address, index):
+		Endpoint.__init__(self, bench, address, "\r\n")
+		self.nick = self.base = "c%d" % index
+		self.channels = []
+		self.send("NICK %s" % self.nick)
+		self.send("USER %s 0 * :load client %d" % (self.nick, index))
+
+	def handle (self, line, now):
+		if line.startswith("PING "):
+			self.send("PONG %s" % line[5:])
+		elif " PRIVMSG " in line:
+			self.delivery(line, now)
+		elif not self.ready and " 001 " in line:
+			self.ready = True
+			self.bench.registered += 1
+
+	def act (self, action, now):
+		channel = random.choice(self.channels)
+		if action == "PRIVMSG":
+			self.send("PRIVMSG %s :%s %.6f" % (channel, MARK, now))
+		elif action == "NICK":
+			self.nick = self.base if self.nick != self.base else self.base + "x"
+			self.send("NICK %s" % self.nick)
+		elif action == "MODE":
+			self.send("MODE %s" % channel)
+		elif action == "WHO":
+			self.send("WHO %s" % channel)
+
+class Peer (Endpoint):
+	"""a stand-in PRC server link introducing users of its own"""
+	def __init__ (self, bench, address, index, users):
+		Endpoint.__init__(self, bench, address, "\n")
+		self.index = index
+		self.users = ["p%dn%d" % (index, i) for i in xrange(users)]
+		self.channels = {}
+		self.ready = True
+		self.send("BOOTSTRAP * bench%d.invalid %d :load peer" %
+		 (index, 1 + index))
+		for nick in self.users:
+			self.send(":%s USER * * * :load peer user" % self.hostmask(nick))
+
+	def hostmask (self, nick):
+		return "%s!%s@bench%d.invalid" % (nick, nick, self.index)
+
+	def join (self, nick, channel):
+		self.channels.setdefault(nick, []).append(channel)
+		self.send(":%s JOIN %s" % (self.hostmask(nick), channel))
+
+	def handle (self, line, now):
+		if line.startswith("PING "):
+			self.send("PONG %s" % line[5:])
+		elif " PRIVMSG " in line:
+			self.delivery(line, now)
+
+	def act (self, action, now):
+		nick = random.choice(self.users)
+		self.send(":%s PRIVMSG %s :%s %.6f" % (self.hostmask(nick),
+		 random.choice(self.channels[nick]), MARK, now))
+
+class Bench ():
+	def __init__ (self):
+		self.poller = select.poll()
+		self.endpoints = {}
+		self.registered = 0
+		self.lost = 0
+		self.samples = []
+		self.recording = False
+
+	def add (self, endpoint):
+		self.endpoints[endpoint.sock.fileno()] = endpoint
+		self.poller.register(endpoint.sock, select.POLLIN)
+
+	def want_write (self, endpoint, enabled):
+		self.poller.modify(endpoint.sock,
+		 select.POLLIN | select.POLLOUT if enabled else select.POLLIN)
+
+	def deliver (self, latency):
+		if self.recording:
+			self.samples.append(latency)
+
+	def poll (self, timeout):
+		for fd, mask in self.poller.poll(timeout * 1000):
+			endpoint = self.endpoints.get(fd)
+			if not endpoint:
+				continue
+			try:
+				if mask & (select.POLLIN | select.POLLERR | select.POLLHUP):
+					endpoint.read()
+				if mask & select.POLLOUT and endpoint.out:
+					endpoint.flush()
+			except socket.error:
+				self.drop(endpoint)
+
+	def drop (self, endpoint):
+		"""forgets an endpoint the gateway disconnected"""
+		del self.endpoints[endpoint.sock.fileno()]
+		self.poller.unregister(endpoint.sock)
+		endpoint.sock.close()
+		endpoint.closed = True
+		self.lost += 1
+
+	def pump (self, seconds):
+		end = time.time() + seconds
+		while time.time() < end:
+			self.poll(0.05)
+
+class Gateway ():
+	"""the prc.py under test, run from a scratch directory so it does not
+	touch the hostcache of the checkout; settings in extra are added to
+	the end of the config"""
+	def __init__ (self, name, python, extra = ()):
+		self.dir = tempfile.mkdtemp(prefix = "prc-bench-")
+		os.mkdir(os.path.join(self.dir, "config"))
+		shutil.copy(os.path.join(ROOT, "config", name),
+		 os.path.join(self.dir, "config", name))
+		if extra:
+			with open(os.path.join(self.dir, "config", name), "a") as f:
+				f.write("\n%s\n" % "\n".join(extra))
+		self.process = subprocess.Popen(
+		 [python, os.path.join(ROOT, "prc.py"), name], cwd = self.dir,
+		 stdout = open(os.path.join(self.dir, "gateway.log"), "w"),
+		 stderr = subprocess.STDOUT)
+		self.pid = self.process.pid
+
+	def stop (self):
+		self.process.terminate()
+		self.process.wait()
+		shutil.rmtree(self.dir, True)
+
+def cpu_seconds (pid):
+	"""user + system CPU time of a process, from /proc"""
+	try:
+		with open("/proc/%d/stat" % pid) as f:
+			fields = f.read().rpartition(")")[2].split()
+	except IOError:
+		return None
+	return (int(fields[11]) + int(fields[12])) / float(
+	 os.sysconf("SC_CLK_TCK"))
+
+def memory_kb (pid):
+	"""current and peak resident set size of a process, from /proc"""
+	rss = peak = None
+	try:
+		with open("/proc/%d/status" % pid) as f:
+			for line in f:
+				if line.startswith("VmRSS:"):
+					rss = int(line.split()[1])
+				elif line.startswith("VmHWM:"):
+					peak = int(line.split()[1])
+	except IOError:
+		pass
+	return rss, peak
+
+def percentile (samples, fraction):
+	if not samples:
+		return None
+	return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def revision ():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "--short",
+		 "HEAD"], cwd = ROOT, stderr = open(os.devnull, "w")).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def raise_fd_limit ():
+	"""lifts the open file limit to the hard limit for us and the gateway,
+	which inherits it"""
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	if soft < hard:
+		resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def run (options):
+	raise_fd_limit()
+	logger = log.logger("NONE")
+	conf = config.Main(options.config, logger)
+	local = conf.LOCAL_BIND[0]
+	remote = conf.REMOTE_BIND
+	if local[0] == "0.0.0.0":
+		local = ("127.0.0.1", local[1])
+	if remote[0] == "0.0.0.0":
+		remote = ("127.0.0.1", remote[1])
+
+	gateway = None
+	if not options.attach:
+		gateway = Gateway(options.config, options.python)
+		time.sleep(options.startup)
+	pid = gateway.pid if gateway else options.pid
+
+	bench = Bench()
+	try:
+		clients = []
+		for i in xrange(options.clients):
+			clients.append(Client(bench, local, i))
+			if i % 100 == 99:
+				bench.poll(0)
+		peers = [Peer(bench, remote, i, options.peer_users)
+		 for i in xrange(options.peers)]
+
+		deadline = time.time() + options.timeout
+		while bench.registered < len(clients):
+			if time.time() > deadline:
+				raise SystemExit("only %d of %d clients registered" %
+				 (bench.registered, len(clients)))
+			bench.poll(0.05)
+
+		# channel i gets the clients and peer users with index % count == i,
+		# so sizes come out as even as they can
+		names = ["#load%d" % i for i in xrange(options.channels)]
+		members = clients + [(p, n) for p in peers for n in p.users]
+		per_member = max(1, min(options.channels,
+		 options.channel_size * options.channels / max(1, len(members))))
+		for i, member in enumerate(members):
+			for j in xrange(per_member):
+				channel = names[(i + j) % len(names)]
+				if isinstance(member, Client):
+					member.channels.append(channel)
+					member.send("JOIN %s" % channel)
+				else:
+					member[0].join(member[1], channel)
+		bench.pump(options.settle)
+
+		actions = []
+		for action, weight in (("PRIVMSG", options.privmsg),
+		 ("NICK", options.nick), ("MODE", options.mode),
+		 ("WHO", options.who)):
+			actions += [action] * weight
+		senders = clients + [p for p in peers if p.users] * options.peer_weight
+
+		bench.pump(options.warmup)
+		cpu_start = cpu_seconds(pid) if pid else None
+		bench.recording = True
+		start = time.time()
+		end = start + options.duration
+		sent = 0
+		now = start
+		while now < end:
+			due = int((now - start) * options.rate) - sent
+			for i in xrange(due):
+				sender = random.choice(senders)
+				sender.act("PRIVMSG" if isinstance(sender, Peer) else
+				 random.choice(actions), now)
+			sent += max(due, 0)
+			bench.poll(0.001)
+			now = time.time()
+		elapsed = now - start
+		bench.recording = False
+		cpu_end = cpu_seconds(pid) if pid else None
+		rss, peak = memory_kb(pid) if pid else (None, None)
+		bench.pump(options.drain)
+	finally:
+		if gateway:
+			gateway.stop()
+
+	samples = sorted(bench.samples)
+	latency = dict((name, percentile(samples, fraction)) for name, fraction
+	 in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999), ("max", 1)))
+	return {
+		"revision": revision(),
+		"config": options.config,
+		"parameters": {
+			"clients": options.clients,
+			"peers": options.peers,
+			"peer_users": options.peer_users,
+			"channels": options.channels,
+			"channel_size": options.channel_size,
+			"rate": options.rate,
+			"duration": options.duration,
+			"mix": {"privmsg": options.privmsg, "nick": options.nick,
+			 "mode": options.mode, "who": options.who},
+		},
+		"sent": sent,
+		"sent_per_second": sent / elapsed,
+		"delivered": len(samples),
+		"delivered_per_second": len(samples) / elapsed,
+		"latency_ms": dict((name, value * 1e3 if value is not None else None)
+		 for name, value in latency.iteritems()),
+		"disconnected": bench.lost,
+		"cpu_seconds": cpu_end - cpu_start if cpu_start is not None else None,
+		"cpu_percent": (cpu_end - cpu_start) / elapsed * 100
+		 if cpu_start is not None else None,
+		"rss_kb": rss,
+		"peak_rss_kb": peak,
+	}
+
+def report (result):
+	latency = result["latency_ms"]
+	print "sent       %9d  (%.0f/s)" % (result["sent"],
+	 result["sent_per_second"])
+	print "delivered  %9d  (%.0f/s)" % (result["delivered"],
+	 result["delivered_per_second"])
+	if result["disconnected"]:
+		print "lost       %9d  connections" % result["disconnected"]
+	if latency["p50"] is not None:
+		print "latency    p50 %.2f ms  p99 %.2f ms  p999 %.2f ms  max %.2f ms" % (
+		 latency["p50"], latency["p99"], latency["p999"], latency["max"])
+	if result["cpu_percent"] is not None:
+		print "cpu        %.2f s  (%.0f%%)" % (result["cpu_seconds"],
+		 result["cpu_percent"])
+	if result["rss_kb"] is not None:
+		print "rss        %d kB  (peak %d kB)" % (result["rss_kb"],
+		 result["peak_rss_kb"])
+
+def main ():
+	parser = argparse.ArgumentParser(description = __doc__.split("\n")[0])
+	parser.add_argument("config", help = "config file name in config/")
+	parser.add_argument("--clients", type = int, default = 500)
+	parser.add_argument("--peers", type = int, default = 0,
+	 help = "stand-in PRC peer links")
+	parser.add_argument("--peer-users", type = int, default = 50,
+	 help = "users introduced by each peer")
+	parser.add_argument("--peer-weight", type = int, default = 10,
+	 help = "how much more often a peer sends than a client")
+	parser.add_argument("--channels", type = int, default = 20)
+	parser.add_argument("--channel-size", type = int, default = 50,
+	 help = "target members per channel")
+	parser.add_argument("--rate", type = float, default = 1000,
+	 help = "messages per second, all senders together")
+	parser.add_argument("--privmsg", type = int, default = 85,
+	 help = "weight of channel PRIVMSGs in the client mix")
+	parser.add_argument("--nick", type = int, default = 5)
+	parser.add_argument("--mode", type = int, default = 5)
+	parser.add_argument("--who", type = int, default = 5)
+	parser.add_argument("--duration", type = float, default = 10)
+	parser.add_argument("--warmup", type = float, default = 1)
+	parser.add_argument("--settle", type = float, default = 2,
+	 help = "seconds to let JOINs finish")
+	parser.add_argument("--drain", type = float, default = 0.5)
+	parser.add_argument("--startup", type = float, default = 1,
+	 help = "seconds to give prc.py to start")
+	parser.add_argument("--timeout", type = float, default = 60,
+	 help = "seconds to wait for every client to register")
+	parser.add_argument("--attach", action = "store_true",
+	 help = "use a gateway that is already running")
+	parser.add_argument("--pid", type = int,
+	 help = "pid of that gateway, for CPU and RSS numbers")
+	parser.add_argument("--python", default = sys.executable,
+	 help = "interpreter to run prc.py with")
+	parser.add_argument("--json", help = "write the results to this file")
+	options = parser.parse_args()
+
+	result = run(options)
+	report(result)
+	if options.json:
+		with open(options.json, "w") as f:
+			json.dump(result, f, indent = 1, sort_keys = True)
+
+if __name__ == "__main__":
+	main()
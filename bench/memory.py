@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""memory per known user and per channel membership: the old dict-backed
+User/ChannelUser/Channel against the slotted ones, each built in its own
+forked process and measured by the growth of its resident set
+
+	python bench/memory.py [users] [channels per user]"""
+
+import gc
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+ os.pardir))
+
+import channel
+import log
+import user
+
+CHANNELS = 2000
+# remote users arrive from a few hosts; idents and gecos repeat too
+HOSTS = ["%016x.onion" % random.Random(i).getrandbits(64) for i in xrange(200)]
+IDENTS = ["~user", "prc", "anon", "ident"] + ["id%d" % i for i in xrange(60)]
+
+class Link (object):
+	"""stands in for the RemoteConnection remote users are behind"""
+	internal = False
+	routed = False
+	logger = log.logger("ERROR")
+
+# the classes as they were, for the "before" numbers
+
+class LegacyUser ():
+	def __init__ (self, conn, address, local, nick, ident, logger,
+	 gecos = "", localconn = None):
+		self.conn = conn
+		self.localconn = localconn
+		self.address = address
+		self.local = local
+		self.nick = nick
+		self.ident = ident
+		self.gecos = gecos
+		self.logger = logger
+		self.host = address
+		self.hostmask = None
+		self.hostmask_lower = None
+		self.channels = []
+		self.neighbours = {}
+		self.away = None
+		self.isoper = False
+
+class LegacyChannelUser ():
+	def __init__ (self, user):
+		self.user = user
+		self.status = 0
+
+class LegacyChannel ():
+	def __init__ (self, name):
+		self.name = name
+		self.members = {}
+		self.nicks = {}
+		self.local = set()
+		self.unique = {}
+		self.topic = ""
+		self.immutable = False
+		self.modeflags = set()
+		self.blist = {"I": set(), "b": set(), "e": set()}
+		self.matchers = {}
+
+	def add_member (self, raw_user):
+		member = LegacyChannelUser(raw_user)
+		self.members[raw_user] = member
+		self.nicks[raw_user.nick.lower()] = member
+		self.unique.setdefault(raw_user.conn, []).append(member)
+		raw_user.channels.append(self.name.lower())
+
+def fresh (s):
+	"""a copy of s, as a string parsed off the wire would be"""
+	return (s + " ")[:-1]
+
+def make_user (variant, link, i):
+	nick = "nick%d" % i
+	ident = fresh(IDENTS[i % len(IDENTS)])
+	host = fresh(HOSTS[i % len(HOSTS)])
+	gecos = "PRC user %d" % i
+	if variant == "before":
+		return LegacyUser(conn = link, address = (host, 0), local = False,
+		 nick = nick, ident = ident, logger = link.logger, gecos = gecos)
+	return user.User(conn = link, host = host, local = False, nick = nick,
+	 ident = ident, gecos = gecos)
+
+def rss ():
+	gc.collect()
+	with open("/proc/self/statm") as f:
+		return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def run (variant, count, joins):
+	Channel = LegacyChannel if variant == "before" else channel.Channel
+	link = Link()
+	pick = random.Random(1)
+	start = rss()
+	users = [make_user(variant, link, i) for i in xrange(count)]
+	for u in users:
+		# WHO, bans and fanout build these soon after a user shows up
+		u.hostmask = "%s!%s@%s" % (u.nick, u.ident, u.host)
+		u.hostmask_lower = u.hostmask.lower()
+	made = rss()
+	chans = [Channel("#Channel%d" % i) for i in xrange(CHANNELS)]
+	opened = rss()
+	for u in users:
+		for c in pick.sample(chans, joins):
+			c.add_member(u)
+	joined = rss()
+	return {"user": float(made - start) / count,
+	 "channel": float(opened - made) / CHANNELS,
+	 "membership": float(joined - opened) / (count * joins)}, (users, chans)
+
+def measure (variant, count, joins):
+	"""runs one variant in a child, so neither sees the other's heap"""
+	r, w = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(r)
+		# the objects are kept until the child exits without tearing
+		# them down
+		result, objects = run(variant, count, joins)
+		os.write(w, json.dumps(result))
+		os._exit(0)
+	os.close(w)
+	data = ""
+	while True:
+		chunk = os.read(r, 4096)
+		if not chunk:
+			break
+		data += chunk
+	os.close(r)
+	os.waitpid(pid, 0)
+	return json.loads(data)
+
+def main ():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	joins = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+	print "%d remote users, %d channels, %d channels per user" % (count,
+	 CHANNELS, joins)
+	for name in ("before", "after"):
+		result = measure(name, count, joins)
+		print "%-6s %6.0f bytes/user %6.0f bytes/channel %5.0f bytes/membership" % (
+		 name, result["user"], result["channel"], result["membership"])
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""case folding for nicks and channel names
+
+a name is folded once where it comes in (the User and Channel keep
+theirs as .key), so the registries are looked up with folded keys and
+the display case is left as it was given. every gateway on a network
+has to fold the same way, set by CASEMAPPING in the config"""
+
+import string
+
+tables = {
+	"ascii": string.maketrans(string.ascii_uppercase,
+	 string.ascii_lowercase),
+	# [ ] \ ~ are the upper case of { } | ^
+	"rfc1459": string.maketrans(string.ascii_uppercase + "[]\\~",
+	 string.ascii_lowercase + "{}|^"),
+}
+
+name = "ascii"
+table = tables[name]
+
+def configure (mapping):
+	global name, table
+	name = mapping
+	table = tables[mapping]
+
+def fold (s):
+	"""the folded form of a nick or channel name"""
+	return s.translate(table)
+
+class CaseMap (dict):
+	"""a dict keyed by folded names
+
+	the dict methods take keys that are already folded, a User.key or
+	Channel.key or a name that went through fold() once at the start of
+	a handler; the *_name methods fold a name as given for callers that
+	look it up only once"""
+	def get_name (self, name, default = None):
+		return self.get(fold(name), default)
+
+	def has_name (self, name):
+		return fold(name) in self
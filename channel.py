@@ -26,20 +26,43 @@
 # The views and conclusions contained in the software and documentation are
 # those of the authors and should not be interpreted as representing official
 # policies, either expressed or implied, of the FreeBSD Project.
+import casemap
 import fnmatch
-class ChannelUser ():
+import message
+import metrics
+import re
+from collections import deque
+
+# set by connections.py; called with a channel when its first member on
+# this gateway joins or its last one leaves, so the server links can be
+# told which channels we want to hear about
+interest_changed = None
+
+class ChannelUser (object):
+	"""a user's membership of a channel; status indexes status_modes"""
+	__slots__ = ("user", "status")
+
 	def __init__ (self, user):
 		self.user = user
 		self.status = 0
 	def set_status (self, num):
 		self.status = num
 
-class Channel ():
+class Channel (object):
+	__slots__ = ("name", "key", "members", "nicks", "local", "unique", "topic",
+	 "immutable", "modeflags", "blist", "matchers")
 	status_prefixes = [ str(), "+", "%", "@", "!" ]
 	status_modes = [ str(), "v", "h", "o", "a" ]
 	def __init__ (self, name, immutable = False):
 		self.name = name
-		self.members = []
+		# the folded name, shared by the channels list of every member
+		self.key = intern(casemap.fold(name))
+		# ChannelUsers indexed by User and by User.key
+		self.members = {}
+		self.nicks = casemap.CaseMap()
+		# local members, and remote members grouped by the link they
+		# are behind, so fanout only touches each recipient once
+		self.local = set()
 		self.unique = {}
 		self.topic = ""
 		self.immutable = immutable
@@ -48,62 +71,88 @@ class Channel ():
 		self.blist["I"] = set()
 		self.blist["b"] = set()
 		self.blist["e"] = set()
-		#self.logger.log_line("DEBUG", "channel %s created" % self.name)
+		# (exact masks, compiled wildcard masks) per list, built on demand
+		self.matchers = {}
+		#self.logger.log("DEBUG", "channel %s created", self.name)
 	def mode_to_status (self, mode):
 		return self.status_modes.index(mode)
 	def get_userbyname (self, name):
-		name = name.lower()
-		for member in self.members:
-			if member.user.nick.lower() == name:
-				return member
-		return None
+		return self.nicks.get_name(name)
 	def get_channeluser (self, user):
-		if user in self.members: return user
-		for member in self.members:
-			if member.user is user:
-				return member
-		return None
+		if isinstance(user, ChannelUser): return user
+		return self.members.get(user)
+	def rename_user (self, user, oldkey):
+		"""moves a member to its new nick in the nick index"""
+		member = self.nicks.pop(oldkey, None)
+		if member:
+			self.nicks[user.key] = member
+	def add_mask (self, type, mask):
+		self.blist[type].add(casemap.fold(mask))
+		self.matchers.pop(type, None)
+	def remove_mask (self, type, mask):
+		self.blist[type].discard(casemap.fold(mask))
+		self.matchers.pop(type, None)
+	def compile_masks (self, type):
+		"""splits a list into a set of plain masks and one regex for all
+		the wildcard masks"""
+		exact = set()
+		wild = []
+		for mask in self.blist[type]:
+			if "*" in mask or "?" in mask or "[" in mask:
+				wild.append("(?:%s)" % fnmatch.translate(mask))
+			else:
+				exact.add(mask)
+		return (exact, re.compile("|".join(wild)).match if wild else None)
+	def matches (self, type, user):
+		if not self.blist[type]:
+			return False
+		if type not in self.matchers:
+			self.matchers[type] = self.compile_masks(type)
+		exact, match = self.matchers[type]
+		hostmask = user.lower_hostmask()
+		return hostmask in exact or bool(match and match(hostmask))
 	def is_banned (self, user):
-		for ban in self.blist["b"]:
-			if fnmatch.fnmatchcase(user.full_hostmask().lower(), ban.lower()):
-				return True
-		return False
+		return self.matches("b", user)
 	def is_exception (self, user):
-		for ex in self.blist["e"]:
-			if fnmatch.fnmatchcase(user.full_hostmask().lower(), ex.lower()):
-				return True
-		return False
+		return self.matches("e", user)
 	def is_really_banned (self, user):
 		return (self.is_banned(user) and (not self.is_exception(user)))
 	def is_invex (self, user):
-		for invex in self.blist["I"]:
-			if fnmatch.fnmatchcase(user.full_hostmask().lower(), invex.lower()):
-				return True
-		return False
+		return self.matches("I", user)
 
 	def set_status (self, user, num):
 		user = self.get_channeluser(user)
 		if num == -1: num = len(self.status_prefixes) - 1
 		user.set_status(num)
 	def send (self, line, local, omit = None):
-		for member in self.members:
+		# format once; every recipient queues the same string
+		data = "%s\r\n" % line
+		for member in self.local:
 		# first send to local users
-			if not member.user.local:
-				continue
-			if member is omit:
+			if member is not omit:
 			# don't send privmsg/notice to oneself
-				continue
-			member.user.send(line)
+				member.user.conn.queue(data)
+		metrics.count_line("lines_out", line,
+		 len(self.local) - (omit in self.local))
 
 		if not local:
 		# we don't need to send to remote users if this is a remote
 		# message; they already did that
 			return
 
-		for client in self.unique.itervalues():
+		# only tagged links take an event id, so one is drawn on the first
+		tagged = None
+		for conn in self.unique:
 		# then send to remote CONNECTIONS, not users, otherwise we get
 		# duplicate messages
-			client[0].user.send(line)
+			if not conn.tagged:
+				conn.queue(data)
+				continue
+			if tagged is None:
+				tagged = "%s\r\n" % message.tag(line)
+			conn.queue(tagged)
+		if self.unique:
+			metrics.count_line("link_lines_out", line, len(self.unique))
 
 	def send_mode_change (self, user, string):
 		user = self.get_channeluser(user)
@@ -117,24 +166,53 @@ class Channel ():
 	def send_names (self, user):
 		# TODO # should loop for long NAMES lists >512bytes
 		user.send_numeric(353, "= %s :%s" %
-		 (self.name, " ".join(["%s%s" % (self.status_prefixes[member.status], member.user.nick) for member in self.members])))
+		 (self.name, " ".join(["%s%s" % (self.status_prefixes[member.status], member.user.nick) for member in self.members.itervalues()])))
 		user.send_numeric(366, "%s :End of NAMES" % (self.name))
 
-	def join_user (self, raw_user, local = None, status = 0):
+	def interested (self):
+		"""whether anyone on this gateway is in the channel; for worker 0
+		that includes the users of the other workers"""
+		if self.local:
+			return True
+		for conn in self.unique:
+			if conn.internal:
+				return True
+		return False
+
+	def add_member (self, raw_user):
+		"""the bookkeeping side of a join; nobody is told about it"""
+		ours = raw_user.local or raw_user.conn.internal
+		gained = ours and not self.interested()
 		user = ChannelUser(raw_user)
-		self.members.append(user)
-		if not user.user.local:
-			if not user.user.sock in self.unique:
-				self.unique[user.user.sock] = []
-			self.unique[user.user.sock].append(user)
-		user.user.channels.append(self.name.lower())
+		for member in self.local:
+			raw_user.add_neighbour(member.user)
+		if raw_user.local:
+			for member in self.members.itervalues():
+				member.user.add_neighbour(raw_user)
+		self.members[raw_user] = user
+		self.nicks[raw_user.key] = user
+		if raw_user.local:
+			self.local.add(user)
+		else:
+			if not user.user.conn in self.unique:
+				self.unique[user.user.conn] = []
+			self.unique[user.user.conn].append(user)
+		user.user.channels.append(self.key)
+		if gained and interest_changed:
+			interest_changed(self)
+		return user
+
+	def join_user (self, raw_user, local = None, status = 0):
+		user = self.add_member(raw_user)
 		self.send(":%s JOIN %s" % (user.user.full_hostmask(), self.name),
 		 user.user.local)
 		if not local:
-			for member in self.members:
+			if raw_user.conn.routed:
+				# the link got our side of the channel when it said it
+				# wanted it
+				return
+			for member in self.local:
 			# tell the (remote) joining user about all our local users
-				if not member.user.local:
-					continue
 				user.user.send(":%s JOIN %s" % (member.user.full_hostmask(), self.name))
 				if member.status > 0:
 					user.user.send(":%s MODE %s +%s %s" % (member.user.full_hostmask(), self.name, self.status_modes[member.status], member.user.nick))
@@ -149,26 +227,51 @@ class Channel ():
 		self.set_status(user, status)
 		self.send_names(local)
 
+	def join_burst (self, joins):
+		"""joins the (remote user, status) pairs of a netburst; the link
+		gets our side of the channel in our own burst, so unlike
+		join_user() nothing is replayed to it"""
+		for raw_user, status in joins:
+			user = self.add_member(raw_user)
+			user.set_status(status)
+			self.send(":%s JOIN %s" % (raw_user.full_hostmask(), self.name),
+			 False)
+			if status:
+				self.send(":%s MODE %s +%s %s" % (raw_user.full_hostmask(),
+				 self.name, self.status_modes[status], raw_user.nick), False)
+
 	def quit_user (self, user):
 		user = self.get_channeluser(user)
-		if self.name.lower() not in user.user.channels: return
-		user.user.channels.remove(self.name.lower())
+		if not user or self.key not in user.user.channels: return
+		user.user.channels.remove(self.key)
 		# QUIT was already sent
-		self.members.remove(user)
+		del self.members[user.user]
+		if self.nicks.get(user.user.key) is user:
+			del self.nicks[user.user.key]
+		for member in self.local:
+			user.user.remove_neighbour(member.user)
 		if user.user.local:
-			return
-		self.unique[user.user.sock].remove(user)
-		if not self.unique[user.user.sock]:
-			del self.unique[user.user.sock]
+			for member in self.members.itervalues():
+				member.user.remove_neighbour(user.user)
+			self.local.discard(user)
+		else:
+			self.unique[user.user.conn].remove(user)
+			if not self.unique[user.user.conn]:
+				del self.unique[user.user.conn]
+		if ((user.user.local or user.user.conn.internal) and
+		 interest_changed and not self.interested()):
+			interest_changed(self)
 
 	def part_user (self, user, message = None):
 		user = self.get_channeluser(user)
+		if not user: return
 		self.send(":%s PART %s%s" % (user.user.full_hostmask(), self.name,
 			 " :" + message if message else ""), user.user.local)
 		self.quit_user(user)
 	def kick_user (self, source, user, message = None):
 		user = self.get_channeluser(user)
 		source = self.get_channeluser(source)
+		if not user or not source: return
 		self.send(":%s KICK %s %s%s" % (source.user.full_hostmask(), self.name, user.user.nick,
 			 " :" + message if message else ""), source.user.local)
 		self.quit_user(user)
@@ -180,4 +283,75 @@ class Channel ():
 			 self.topic), user.user.local)
 
 	#def __del__ (self):
-		#self.logger.log_line("DEBUG", "channel %s deleted" % self.name)
+		#self.logger.log("DEBUG", "channel %s deleted", self.name)
+
+class TapChannel (Channel):
+	"""a debug channel the gateway writes into, like &rawlog and &errors
+
+	while nobody is joined a line costs at most an append to the backlog
+	ring; subscribers can narrow the feed down with filters on command,
+	nick or link (host), thin it out by sampling, and replay the
+	backlog"""
+	__slots__ = ("type", "backlog", "filters", "sample", "count")
+	filter_types = ("command", "nick", "link")
+	# how a value is compared under each filter: nicks folded the way the
+	# network folds them, commands and hosts just lower case
+	filter_folds = {"command": str.lower, "nick": casemap.fold,
+	 "link": str.lower}
+	def __init__ (self, name, type, backlog = 0):
+		Channel.__init__(self, name, immutable = True)
+		self.type = type
+		self.backlog = None
+		self.set_backlog(backlog)
+		self.filters = {}
+		self.sample = 1
+		self.count = 0
+	def set_backlog (self, size):
+		self.backlog = deque(self.backlog or (), size) if size else None
+	def set_filter (self, type, values):
+		if values:
+			fold = self.filter_folds[type]
+			self.filters[type] = set(fold(value) for value in values)
+		else:
+			self.filters.pop(type, None)
+	def wanted (self, nick, link, command):
+		# nick may be a full n!u@h prefix and link an (host, port) pair;
+		# they are only picked apart here, once a line is really wanted
+		for type, value in (
+		 ("command", command),
+		 ("nick", nick and nick.split("!", 1)[0]),
+		 ("link", link and link[0])):
+			if type in self.filters and (not value or
+			 self.filter_folds[type](value) not in self.filters[type]):
+				return False
+		return True
+	def render (self, nick, link, line):
+		if link:
+			return "%s:%d %s" % (link[0], link[1], line)
+		return "%s %s" % (nick, line) if nick else line
+	def tap (self, nick, link, command, line):
+		if self.backlog is not None:
+			self.backlog.append((nick, link, command, line))
+		if not self.local:
+			return
+		if self.filters and not self.wanted(nick, link, command):
+			return
+		if self.sample > 1:
+			self.count += 1
+			if self.count % self.sample:
+				return
+		Channel.send_message(self, None, self.type,
+		 self.render(nick, link, line))
+	def send_message (self, user, type, message):
+		if user is None:
+			self.tap(None, None, None, message)
+		else:
+			Channel.send_message(self, user, type, message)
+	def replay (self, user, count):
+		"""sends the last count backlog entries to a local user"""
+		if count <= 0:
+			return
+		entries = list(self.backlog or ())
+		for nick, link, command, line in entries[-count:]:
+			user.send(":-server-!server@server %s %s :%s" % (self.type,
+			 self.name, self.render(nick, link, line)))
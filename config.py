@@ -47,6 +47,26 @@ class Main():
 		self.OPERATOR = {}
 		self.REMOTE_BIND = ("0.0.0.0", 16700)
 		self.HOSTNAME = None
+		self.RUNTIME = "events"
+		self.CASEMAPPING = "ascii"
+		self.SENDQ_CLIENT = 65536
+		self.SENDQ_SERVER = 4194304
+		self.LINELEN_CLIENT = 1024
+		self.LINELEN_SERVER = 65536
+		self.TAP_BACKLOG = 128
+		self.CONNECT_TIMEOUT = 30
+		self.CONNECT_MAX = 8
+		self.BOOTSTRAP_RACE = 3
+		self.PING_INTERVAL = 128
+		self.PING_TIMEOUT = 128
+		self.WORKERS = 1
+		self.LINK_ZLIB = 0
+		self.METRICS_BIND = None
+		self.GC_THRESHOLD = None
+		self.GC_INTERVAL = 0
+		self.PROFILE_DIR = "profiles"
+		self.LOG_FILE = None
+		self.LOG_ROTATE = (0, 0)
 
 		with open(os.path.join("config", self.file)) as f:
 			print "config.py: Opening %s for parsing" % self.file
@@ -60,61 +80,115 @@ class Main():
 					pass
 				elif line[0] == "BOOTSTRAP":
 					self.BOOTSTRAP = str(" ".join(line[1:]))
-					self.logger.log_line("INFO", "config.py: BOOTSTRAP = %s" %
+					self.logger.log("INFO", "config.py: BOOTSTRAP = %s",
 					 self.BOOTSTRAP)
 
 				elif line[0] == "CHANNELLEN":
 					self.CHANNELLEN = int(line[1])
-					self.logger.log_line("INFO", "config.py: CHANNELLEN = %d" %
+					self.logger.log("INFO", "config.py: CHANNELLEN = %d",
 					 self.CHANNELLEN)
 				elif line[0] == "HOSTNAME":
 					self.HOSTNAME = str(line[1])
-					self.logger.log_line("INFO", "config.py: HOSTNAME = %s" %
+					self.logger.log("INFO", "config.py: HOSTNAME = %s",
 					 self.HOSTNAME)
 					if self.NAME == "prc.gateway": self.NAME = self.HOSTNAME
 				elif line[0] == "MOTD":
 					self.MOTD = str(line[1])
 
-				elif line[0] in ("LOCAL_BIND", "REMOTE_BIND"):
+				elif line[0] in ("LOCAL_BIND", "REMOTE_BIND", "METRICS_BIND"):
 					if len(line) < 3:
 						# we're expecting a tuple of 2 values: host and port
-						self.logger.log_line("ERROR", "config.py: %s is not in format '%s host port'" %
-						 line[0])
+						self.logger.log("ERROR", "config.py: %s is not in format '%s host port'",
+						 line[0], line[0])
 						exit()
 					if line[0] == "LOCAL_BIND":
 						self.LOCAL_BIND.append((str(line[1]), int(line[2])))
-						self.logger.log_line("INFO",
-						 "config.py: LOCAL_BIND += %s" % (self.LOCAL_BIND[-1],))
+						self.logger.log("INFO",
+						 "config.py: LOCAL_BIND += %s", self.LOCAL_BIND[-1])
 					elif line[0] == "REMOTE_BIND":
 						self.REMOTE_BIND = (str(line[1]), int(line[2]))
-						self.logger.log_line("INFO",
-						 "config.py: REMOTE_BIND = %s" % (self.REMOTE_BIND,))
+						self.logger.log("INFO",
+						 "config.py: REMOTE_BIND = %s", self.REMOTE_BIND)
+					elif line[0] == "METRICS_BIND":
+						self.METRICS_BIND = (str(line[1]), int(line[2]))
+						self.logger.log("INFO",
+						 "config.py: METRICS_BIND = %s", self.METRICS_BIND)
 
 				elif line[0] == "LOG_LEVEL":
 					self.logger.set_level( str(line[1]) )
-					self.logger.log_line("INFO",
-					 "config.py: LOG level = %d (%s)" %
-					 (self.logger.loglevel, line[1]))
+					self.logger.log("INFO",
+					 "config.py: LOG level = %d (%s)",
+					 self.logger.loglevel, line[1])
+
+				elif line[0] == "LOG_FILE":
+					self.LOG_FILE = str(line[1])
+					self.logger.log("INFO", "config.py: LOG_FILE = %s",
+					 self.LOG_FILE)
+
+				elif line[0] == "LOG_ROTATE":
+					# rotate once the file reaches this many bytes, keeping
+					# this many old files around
+					self.LOG_ROTATE = (int(line[1]),
+					 int(line[2]) if len(line) > 2 else 5)
+					self.logger.log("INFO", "config.py: LOG_ROTATE = %d %d",
+					 *self.LOG_ROTATE)
+
+				elif line[0] == "GC_THRESHOLD":
+					# gc.set_threshold() values; 0 turns automatic
+					# collection off, leaving it to GC_INTERVAL
+					self.GC_THRESHOLD = tuple(int(n) for n in line[1:4])
+					self.logger.log("INFO", "config.py: GC_THRESHOLD = %s",
+					 " ".join(str(n) for n in self.GC_THRESHOLD))
+
+				elif line[0] == "PROFILE_DIR":
+					self.PROFILE_DIR = str(line[1])
+					self.logger.log("INFO", "config.py: PROFILE_DIR = %s",
+					 self.PROFILE_DIR)
 
 				elif line[0] == "NETWORK":
 					self.NETWORK = str(line[1])
-					self.logger.log_line("INFO", "config.py: NETWORK = %s" %
+					self.logger.log("INFO", "config.py: NETWORK = %s",
 					 self.NETWORK)
 
 				elif line[0] == "NICKLEN":
 					self.NICKLEN = int(line[1])
-					self.logger.log_line("INFO", "config.py: NICKLEN = %d" %
+					self.logger.log("INFO", "config.py: NICKLEN = %d",
 					 self.NICKLEN)
 
 				elif line[0] == "OPERATOR":
 					self.OPERATOR[str(line[1])] = str(line[2])
-					self.logger.log_line("INFO",
-					 "config.py: OPERATOR[%s] = ********" % line[1])
+					self.logger.log("INFO",
+					 "config.py: OPERATOR[%s] = ********", line[1])
+
+				elif line[0] == "RUNTIME":
+					if line[1] not in ("events", "asyncore"):
+						self.logger.log("ERROR", "config.py: RUNTIME must be 'events' or 'asyncore'")
+						exit()
+					self.RUNTIME = str(line[1])
+					self.logger.log("INFO", "config.py: RUNTIME = %s",
+					 self.RUNTIME)
+
+				elif line[0] == "CASEMAPPING":
+					# every gateway on the network has to agree on this
+					if line[1].lower() not in ("ascii", "rfc1459"):
+						self.logger.log("ERROR", "config.py: CASEMAPPING must be 'ascii' or 'rfc1459'")
+						exit()
+					self.CASEMAPPING = line[1].lower()
+					self.logger.log("INFO", "config.py: CASEMAPPING = %s",
+					 self.CASEMAPPING)
+
+				elif line[0] in ("SENDQ_CLIENT", "SENDQ_SERVER",
+				 "LINELEN_CLIENT", "LINELEN_SERVER", "TAP_BACKLOG",
+				 "CONNECT_TIMEOUT", "CONNECT_MAX", "BOOTSTRAP_RACE",
+				 "PING_INTERVAL", "PING_TIMEOUT", "WORKERS", "LINK_ZLIB",
+				 "GC_INTERVAL"):
+					setattr(self, line[0], int(line[1]))
+					self.logger.log("INFO", "config.py: %s = %d",
+					 line[0], getattr(self, line[0]))
 
 				elif line[0] == "SPOOF_HOSTS":
 					self.SPOOF_HOSTS = bool(eval(line[1]))
-					self.logger.log_line("INFO", "config.py: SPOOF_HOSTS = %d"
-					 % self.SPOOF_HOSTS)
+					self.logger.log("INFO", "config.py: SPOOF_HOSTS = %d", self.SPOOF_HOSTS)
 
 		if not self.LOCAL_BIND:
 			self.LOCAL_BIND.append(("127.0.0.1", 6777))
@@ -1,20 +1,36 @@
 #!/usr/bin/env python
 
+import casemap
 import channel
+import gc
+import hostcache
+import linebuf
 import log
+import message
+import metrics
 import os.path
+import profiler
+import resolver
 import socket
 import time
 import user
-from errno import EAGAIN
+import zlib
+from collections import deque
+from errno import EAGAIN, EINPROGRESS, EINVAL, EWOULDBLOCK
 
-users = {}
+# not exported by the socket module on python 2; 15 is its value on linux
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+users = casemap.CaseMap()
 servers = []
-channels = {
-	"&errors": channel.Channel("&errors", immutable = True),
+# connections with data queued since the last flush_pending()
+pending = set()
+channels = casemap.CaseMap({
+	"&errors": channel.TapChannel("&errors", "NOTICE"),
 	"&eval": channel.Channel("&eval", immutable = True),
-	"&rawlog": channel.Channel("&rawlog", immutable = True),
-}
+	"&rawlog": channel.TapChannel("&rawlog", "PRIVMSG"),
+})
+rawlog = channels["&rawlog"]
 
 nick_chars = (
 	"abcdefghijklmnopqrstuvwxyz"
@@ -25,16 +41,36 @@ nick_chars = (
 
 class LocalConnections ():
 	"""IRC to PRC interface"""
-	def __init__ (self, name, bind_addresses, olines, motdfile, logger):
+	kind = "client"
+
+	def __init__ (self, name, bind_addresses, olines, motdfile, sendq,
+	 linelen, backlog, ping_interval, ping_timeout, reuseport, profile_dir,
+	 events, logger):
 		self.name = name
+		self.sendq = sendq
+		self.linelen = linelen
+		self.ping_interval = ping_interval
+		self.ping_timeout = ping_timeout
 		self.olines = olines
 		self.logger = logger
-		self.connections = []
+		self.events = events
+		self.connections = set()
 		self.listeners = []
+		self.prune = []
+		managers.append(self)
+		self.profile_dir = profile_dir
+		# [session, requesting connection, summary length, timer] while
+		# PROFILE is running
+		self.profile = None
 		self.motdfile = motdfile
+		channels["&rawlog"].set_backlog(backlog)
+		channels["&errors"].set_backlog(backlog)
 		for bind_address in bind_addresses:
 			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			if reuseport:
+				# workers share the port and the kernel spreads the clients
+				sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
 
 			try:
 				sock.bind(bind_address)
@@ -43,82 +79,136 @@ class LocalConnections ():
 				 (bind_address[0], bind_address[1], e))
 
 			sock.setblocking(0)
-			sock.listen(5)
+			sock.listen(socket.SOMAXCONN)
 			self.listeners.append(sock)
+			self.events.register(sock,
+			 lambda listener = sock: self.accept(listener))
 
-	def loop (self):
-		prune = []
-
-		for connection in self.connections:
-			try:
-				connection.sock.type
-				connection.loop()
-			except socket.error as e:
-				if e.errno == EAGAIN:
-					now = time.time()
-					if (connection.lastseen < now - 128 and
-					 not connection.pinged):
-					 # 128 will be replaced by a config var
-						connection.user.send("PING :%s" % connection.name)
-						connection.pinged = True
-					if connection.lastseen < now - (128 * 2):
-						try:
-							connection.error("Ping timeout: %d seconds" %
-							 (now - connection.lastseen - 128))
-						except socket.error:
-							pass
-					continue
-				if e.errno:
-					e.message = os.strerror(e.errno)
-				for u in users.itervalues():
-					found = False
-					if not u.local or u == connection.user:
-						continue
-					for c in connection.user.channels:
-						if channels[c].get_channeluser(u) in channels[c].members:
-							found = True
-							break
-					if found:
-						u.send(":%s QUIT :%s" %
-						 (connection.user.full_hostmask(), e.message))
-
-				for u in servers:
-					u.send(":%s QUIT :%s" %
-					 (connection.user.full_hostmask(), e.message))
-
-				for c in connection.user.channels[:]:
-					channels[c].quit_user(connection.user)
-					if not channels[c].members and not channels[c].immutable:
-						del channels[c]
-
-				if connection.user.nick.lower() in users:
-					del users[connection.user.nick.lower()]
-
-				self.connections.remove(connection)
-
-		# check connection queue
-		for listener in self.listeners:
+	def accept (self, listener):
+		"""accepts every pending client on a listener"""
+		while True:
 			try:
 				sock, address = listener.accept()
-				self.connections.append( LocalConnection(
-				 self.name,
-				 sock,
-				 address,
-				 self.olines,
-				 self.motdfile,
-				 self.logger) )
-			except socket.error:
-				pass # todo
+			except socket.error as e:
+				if e.errno not in (EAGAIN, EWOULDBLOCK):
+					self.logger.log("WARN", "accept failed: %s", e)
+				return
+			connection = LocalConnection(self, sock, address)
+			self.connections.add(connection)
+			self.events.register(sock,
+			 lambda connection = connection: self.read(connection),
+			 connection.flush)
+
+	def read (self, connection):
+		"""reads from a ready client, closing it on error"""
+		try:
+			connection.loop()
+		except socket.error as e:
+			if e.errno in (EAGAIN, EWOULDBLOCK):
+				return
+			if isinstance(e, linebuf.LineTooLong):
+				# goes out with the last try close() makes at the send queue
+				connection.send("ERROR :%s" % e.message)
+			connection.close(os.strerror(e.errno) if e.errno else e.message)
+
+	def start_profile (self, connection, mode, seconds, count):
+		self.profile = [profiler.Session(mode, self.profile_dir), connection,
+		 count, self.events.call_later(seconds, self.stop_profile)]
+
+	def stop_profile (self):
+		"""ends the PROFILE session and sends its summary to whoever started
+		it, if they are still around"""
+		session, connection, count, timer = self.profile
+		self.profile = None
+		timer.cancel()
+		lines = session.stop(count)
+		self.logger.log("INFO", "%s", lines[0])
+		if not connection.closed:
+			for line in lines:
+				connection.send_notice(line)
+
+	def reap (self):
+		"""tears down the connections closed since the last call"""
+		while self.prune:
+			connection, message = self.prune.pop(0)
+			self.drop(connection, message)
+
+	def drop (self, connection, reason):
+		if connection not in self.connections:
+			return
+		self.connections.remove(connection)
+
+		for u in connection.user.neighbours:
+			u.send(":%s QUIT :%s" %
+			 (connection.user.full_hostmask(), reason))
+
+		line = ":%s QUIT :%s" % (connection.user.full_hostmask(), reason)
+		tagged = None
+		for u in servers:
+			if u.tagged and tagged is None:
+				tagged = message.tag(line)
+			u.send(tagged if u.tagged else line)
+
+		forget_user(connection.user)
+		# the connection and its user only refer to each other now; without
+		# the cycle they go as soon as this returns, not at a collection
+		connection.user.conn = None
+		connection.user = None
 
 class RemoteConnections ():
 	"""PRC to PRC interface"""
-	def __init__ (self, network, bootstrap, bind_address, hostname, logger):
-		self.connections = []
-		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	kind = "server"
+
+	# a failed address waits backoff_base * 2 ** (failures - 1) seconds,
+	# up to backoff_max, before it is tried again
+	backoff_base = 2
+	backoff_max = 300
+	# announced servers are given up on after this many failures in a row
+	retries = 5
+
+	def __init__ (self, network, bootstrap, bind_address, hostname, sendq,
+	 linelen, connect_timeout, connect_max, bootstrap_race, ping_interval,
+	 ping_timeout, zlib_level, worker, events, logger):
+		self.sendq = sendq
+		# links are compressed at this level if both ends offer it; 0 is off
+		self.zlib_level = zlib_level
+		self.linelen = linelen
+		self.ping_interval = ping_interval
+		self.ping_timeout = ping_timeout
+		self.connect_timeout = connect_timeout
+		self.connect_max = connect_max
+		self.connections = set()
+		self.prune = []
+		managers.append(self)
 		self.name = network
 		self.hostname = hostname
 		self.bind_port = bind_address[1]
 		self.logger = logger
+		self.events = events
+		# links to the other worker processes, if there are any
+		self.workers = []
+		# (address, hello) pairs waiting for a free connect slot
+		self.socket_queue = deque()
+		# sock -> [address, hello, timeout timer, started] for connects in
+		# progress
+		self.attempts = {}
+		# address -> [hello, timeout timer, started] for host names being
+		# looked up; these hold a connect slot too
+		self.lookups = {}
+		self.resolver = None
+		# address -> (failures, next attempt time)
+		self.backoff = {}
+		self.bootstrap_hosts = []
+		self.bootstrap_race = bootstrap_race
+		self.hostcache = hostcache.HostCache(
+		 os.path.join("hostcache", self.name), self.logger)
+		if worker:
+			# only worker 0 talks to other servers; the rest reach the
+			# network through their link to it
+			self.sock = None
+			return
+
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		try:
 			self.sock.bind(bind_address)
@@ -126,146 +216,594 @@ class RemoteConnections ():
 			exit("error in LOCAL_BIND address %s:%d (%s)" % (bind_address[0],
 			 bind_address[1], e))
 		self.sock.setblocking(0)
-		self.sock.listen(5)
-		self.socket_queue = []
+		self.sock.listen(socket.SOMAXCONN)
+		self.events.register(self.sock, self.accept)
+		self.events.call_later(60, self.save_hostcache)
+		self.resolver = resolver.Resolver(self.events, self.logger)
 
-		try:
-			if os.path.isfile(os.path.join("hostcache", self.name)):
-				with open(os.path.join("hostcache", self.name)) as hostcache:
-					hosts = hostcache.read().split("\n")
-			elif bootstrap:
-				hosts = [bootstrap]
-			else:
-				hosts = []
+		if bootstrap:
+			host = bootstrap.split()
+			try:
+				self.hostcache.add((host[0], int(host[1])))
+			except (IndexError, ValueError):
+				pass
+		if not self.hostcache:
+			self.logger.log("NOTICE",
+			 "no hostcache file found; not bootstrapping")
+			return
 
-			for host in hosts:
-				try:
-					host = host.split()
-					if len(host) < 2: continue
-					address = (host[0], int(host[1]))
-					self.logger.log_line("DEBUG",
-					 "bootstrapping, trying host %s" % str(address))
-					bootsock = socket.socket(socket.AF_INET,
-					 socket.SOCK_STREAM)
-					bootsock.connect(address)
-					bootsock.setblocking(0)
-					if not self.hostname:
-						self.hostname = bootsock.getsockname()[0]
-					conn = RemoteConnection(
-					 bootsock,
-					 address,
-					 self.socket_queue,
-					 self.logger)
-					self.connections.append(conn)
-					servers.append(conn)
-					conn.send("BOOTSTRAP %s %s %d :%s"
-					 % ("*", self.hostname, self.bind_port, "PRC gateway"))
-					break
-
-				except socket.error as e:
-					pass # todo
+		self.bootstrap_hosts = [h.address for h in self.hostcache.ranked()]
+		self.bootstrap()
 
-			else:
-				self.logger.log_line("NOTICE",
-				 "all hosts in hostcache file are down; not bootstrapping")
+	def save_hostcache (self):
+		"""writes the hostcache out once a minute"""
+		self.hostcache.save()
+		self.events.call_later(60, self.save_hostcache)
 
-		except IOError:
-			self.logger.log_line("NOTICE",
-			 "no hostcache file found; not bootstrapping")
+	def bootstrap (self):
+		"""races connects to the next few best known hosts; the first one up
+		is kept, and the next few are tried if all of them fail"""
+		if not self.bootstrap_hosts:
+			self.logger.log("NOTICE",
+			 "all hosts in hostcache file are down; not bootstrapping")
+			return
+		batch = self.bootstrap_hosts[:self.bootstrap_race]
+		del self.bootstrap_hosts[:self.bootstrap_race]
+		for address in batch:
+			self.logger.log("DEBUG", "bootstrapping, trying host %s", address)
+			self.connect(address, "BOOTSTRAP")
+		if not self.bootstrapping():
+			# every candidate was skipped
+			self.bootstrap()
+
+	def bootstrapping (self):
+		"""whether a bootstrap connect is still queued or in progress"""
+		return ("BOOTSTRAP" in [a[1] for a in self.attempts.itervalues()] or
+		 "BOOTSTRAP" in [l[0] for l in self.lookups.itervalues()] or
+		 "BOOTSTRAP" in [q[1] for q in self.socket_queue])
+
+	def connect (self, address, hello):
+		"""queues a connect to address, which sends hello ("BOOTSTRAP" or
+		"SERVER") once it is up; addresses already linked or being
+		connected to are ignored"""
+		if (address == (self.hostname, self.bind_port) or
+		 address in [s.address for s in servers] or
+		 address in [a[0] for a in self.attempts.itervalues()] or
+		 address in self.lookups or
+		 address in [q[0] for q in self.socket_queue]):
+			return
+		self.socket_queue.append((address, hello))
+		self.process_queue()
+
+	def process_queue (self):
+		"""starts queued connects while there are free slots, leaving the
+		addresses that are still backing off in the queue"""
+		if (not self.socket_queue or
+		 len(self.attempts) + len(self.lookups) >= self.connect_max):
+			return
+		now = time.time()
+		waiting = deque()
+		while (self.socket_queue and
+		 len(self.attempts) + len(self.lookups) < self.connect_max):
+			address, hello = self.socket_queue.popleft()
+			if self.backoff.get(address, (0, 0))[1] > now:
+				waiting.append((address, hello))
+				continue
+			self.start(address, hello, now)
+		waiting.extend(self.socket_queue)
+		self.socket_queue = waiting
+
+	def start (self, address, hello, now):
+		"""begins a connect, looking the host name up first unless it is
+		numeric; completion or failure is picked up by the event loop"""
+		if resolver.numeric(address[0]):
+			self.dial(address, address, hello, now)
+			return
+		self.lookups[address] = [hello,
+		 self.events.call_later(self.connect_timeout, self.lookup_timed_out,
+		 address), now]
+		self.resolver.resolve(address[0], address[1],
+		 lambda ip, error: self.resolved(address, ip, error))
+
+	def resolved (self, address, ip, error):
+		"""carries on with a connect once its host name is looked up"""
+		if address not in self.lookups:
+			# timed out, or lost a bootstrap race, meanwhile
 			return
+		hello, timer, started = self.lookups.pop(address)
+		timer.cancel()
+		if error:
+			self.failed(address, hello, error)
+			return
+		self.dial(address, ip, hello, started)
+
+	def lookup_timed_out (self, address):
+		if address in self.lookups:
+			hello = self.lookups.pop(address)[0]
+			self.failed(address, hello, "Lookup timed out")
+
+	def dial (self, address, ip, hello, now):
+		"""begins a non-blocking connect to ip on behalf of address"""
+		self.logger.log("DEBUG",
+		 "creating new connection to %s:%s", address[0], address[1])
+		# todo: with ssl check against the announced fingerprint
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setblocking(0)
+		try:
+			err = sock.connect_ex(ip)
+			reason = os.strerror(err)
+		except socket.error as e:
+			err = e.errno or EINVAL
+			reason = e.strerror or str(e)
+		self.attempts[sock] = [address, hello,
+		 self.events.call_later(self.connect_timeout, self.timed_out, sock), now]
+		if err not in (0, EINPROGRESS, EWOULDBLOCK):
+			self.fail(sock, reason)
+			return
+		done = lambda: self.connected(sock)
+		self.events.register(sock, done, done)
+		self.events.set_writable(sock, True)
 
+	def connected (self, sock):
+		"""finishes a connect once its socket is writable (or has failed)"""
+		if sock not in self.attempts:
+			return
+		err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+		if err:
+			self.fail(sock, os.strerror(err))
+			return
+		address, hello, timer, started = self.attempts.pop(sock)
+		timer.cancel()
+		self.events.unregister(sock)
+		self.backoff.pop(address, None)
+		self.hostcache.success(address, time.time() - started)
+		if hello == "BOOTSTRAP":
+			# we won the race; the other candidates are not needed
+			self.bootstrap_hosts = []
+			self.socket_queue = deque(q for q in self.socket_queue
+			 if q[1] != "BOOTSTRAP")
+			for other, attempt in self.attempts.items():
+				if attempt[1] == "BOOTSTRAP":
+					del self.attempts[other]
+					attempt[2].cancel()
+					self.events.unregister(other)
+					other.close()
+			for other, lookup in self.lookups.items():
+				if lookup[0] == "BOOTSTRAP":
+					del self.lookups[other]
+					lookup[1].cancel()
+		if not self.hostname:
+			self.hostname = sock.getsockname()[0]
+		conn = self.add(sock, address)
+		conn.offer_capabs()
+		conn.send("%s %s %s %d :%s" %
+		 (hello, "*", self.hostname, self.bind_port, "PRC gateway"))
+		self.process_queue()
+
+	def fail (self, sock, reason):
+		"""gives up on a connect in progress"""
+		address, hello, timer, started = self.attempts.pop(sock)
+		timer.cancel()
+		self.events.unregister(sock)
+		sock.close()
+		self.failed(address, hello, reason)
+
+	def failed (self, address, hello, reason):
+		"""backs off an address that could not be looked up or connected
+		to, and moves on to the next one"""
+		self.hostcache.failure(address)
+		failures = self.backoff.get(address, (0, 0))[0] + 1
+		delay = min(self.backoff_base * 2 ** (failures - 1), self.backoff_max)
+		self.backoff[address] = (failures, time.time() + delay)
+		self.logger.log("DEBUG", "connection to %s:%s failed (%s), "
+		 "next attempt in %d seconds", address[0], address[1], reason, delay)
+
+		if hello == "BOOTSTRAP":
+			if not self.bootstrapping():
+				self.bootstrap()
+		elif failures < self.retries:
+			self.socket_queue.append((address, hello))
+			self.events.call_later(delay, self.process_queue)
+		self.process_queue()
+
+	def timed_out (self, sock):
+		"""fails a connect that has been in progress for too long"""
+		if sock in self.attempts:
+			self.fail(sock, "Connection timed out")
+
+	def add (self, sock, address):
+		"""starts tracking a connected server socket"""
+		conn = RemoteConnection(self, sock, address)
+		self.connections.add(conn)
+		servers.append(conn)
+		self.events.register(sock, lambda: self.read(conn), conn.flush)
+		return conn
+
+	def add_worker (self, sock, index):
+		"""starts tracking the link to another worker process of this
+		gateway
+
+		worker 0 relays between the workers and the rest of the network,
+		so the workers look like a single server from outside"""
+		conn = self.add(sock, ("worker", index))
+		conn.internal = True
+		conn.tagged = True
+		conn.keepalives = True
+		self.workers.append(conn)
+		return conn
+
+	def relay (self, source, line, msg):
+		"""passes a line from one server link on to the ones that would not
+		otherwise see it: lines from a worker go to every other link that
+		wants them, lines from outside go to the workers"""
+		for conn in servers if source.internal else self.workers:
+			if conn is not source and conn.wants_line(msg):
+				conn.send(line)
+
+	def read (self, connection):
+		"""reads from a ready server, closing it on error"""
+		try:
+			connection.loop()
+		except socket.error as e:
+			if e.errno in (EAGAIN, EWOULDBLOCK):
+				return
+			if isinstance(e, linebuf.LineTooLong):
+				# goes out with the last try close() makes at the send queue
+				connection.send("ERROR :%s" % e.message)
+			connection.close(os.strerror(e.errno) if e.errno else e.message)
+
+	def reap (self):
+		"""tears down the connections closed since the last call"""
+		while self.prune:
+			connection, message = self.prune.pop(0)
+			self.drop(connection, message)
+
+	def drop (self, connection, reason):
+		if connection not in self.connections:
+			return
+		self.connections.remove(connection)
+		servers.remove(connection)
+		# nobody else tells our users that the users behind the link are
+		# gone, nor the workers (or, for a lost worker, whose users were
+		# ours as far as the peers know, the links)
+		others = servers if connection.internal else self.workers
+		for u in connection.users.values():
+			line = ":%s QUIT :%s" % (u.full_hostmask(), reason or "Link lost")
+			for n in u.neighbours:
+				n.send(line)
+			tagged = None
+			for s in others:
+				if s.tagged and tagged is None:
+					tagged = message.tag(line)
+				s.send(tagged if s.tagged else line)
+			forget_user(u)
+			u.conn = None
+		connection.users.clear()
+		for target in connection.wants:
+			if not network_wants(target):
+				for conn in self.workers:
+					conn.send("UNWANT %s" % target)
+		if connection.internal:
+			self.workers.remove(connection)
+			if not self.sock:
+				exit("lost the link to worker 0 (%s)" % reason)
+
+	def accept (self):
+		"""accepts every pending server on the listener"""
+		while True:
+			try:
+				sock, address = self.sock.accept()
+			except socket.error as e:
+				if e.errno not in (EAGAIN, EWOULDBLOCK):
+					self.logger.log("WARN", "accept failed: %s", e)
+				return
+			self.add(sock, None)
+
+def forget_user (u):
+	"""takes a user who has quit, or was lost with their connection, out
+	of the channels they are in (deleting those left empty) and out of
+	users; this is all the teardown a user gets, so it costs one
+	Channel.quit_user() per channel of theirs"""
+	for c in u.channels[:]:
+		chan = channels[c]
+		chan.quit_user(u)
+		if not chan.members and not chan.immutable:
+			del channels[c]
+	if users.get(u.key) is u:
+		del users[u.key]
+
+def network_wants (target):
+	"""whether a link has said it has users in a channel; on a worker, the
+	link to worker 0 stands in for all of worker 0's links"""
+	for s in servers:
+		if target in s.wants:
+			return True
+	return False
 
-	def loop (self):
-		prune = []
+def interest_changed (chan):
+	"""tells the links that route by interest that we now want, or no
+	longer want, a channel; once we do not, the members behind those links
+	are dropped, as we would not hear about them leaving"""
+	if chan.name[0] not in "#+":
+		return
+	wanted = chan.interested()
+	for s in servers:
+		if s.routed:
+			s.send("%s %s" % ("WANT" if wanted else "UNWANT", chan.name))
+	if not wanted:
+		for member in chan.members.values():
+			if member.user.conn.routed:
+				chan.quit_user(member)
+				# no worker has users in it either, but they would keep
+				# the member just the same
+				line = ":%s PART %s" % (member.user.full_hostmask(),
+				 chan.name)
+				for conn in member.user.conn.manager.workers:
+					conn.send(line)
+
+channel.interest_changed = interest_changed
+
+def wrap (words, width):
+	"""joins words with spaces into strings of about width characters"""
+	line = []
+	size = 0
+	for word in words:
+		if line and size + len(word) > width:
+			yield " ".join(line)
+			line = []
+			size = 0
+		line.append(word)
+		size += len(word) + 1
+	if line:
+		yield " ".join(line)
+
+def link_name (connection):
+	if not connection.address:
+		return "*"
+	return "%s:%s" % connection.address
+
+def collect_metrics ():
+	"""gauges, and the byte counts of the connections still open"""
+	yield "users", None, len(users)
+	yield "local_users", None, sum(1 for u in users.itervalues() if u.local)
+	yield "channels", None, len(channels)
+	yield "servers", None, len(servers)
+	for manager in managers:
+		kind = manager.kind
+		sendq = 0
+		deepest = 0
+		yield "connections", kind, len(manager.connections)
+		for connection in manager.connections:
+			yield "bytes_in", kind, connection.linebuf.received
+			yield "bytes_out", kind, connection.bytes_out
+			sendq += connection.sendq_len
+			deepest = max(deepest, connection.sendq_len)
+			if kind == "server":
+				name = link_name(connection)
+				yield "link_bytes_in", name, connection.linebuf.received
+				yield "link_bytes_out", name, connection.bytes_out
+				yield "link_sendq_bytes", name, connection.sendq_len
+		yield "sendq_bytes", kind, sendq
+		yield "sendq_max_bytes", kind, deepest
+
+# every LocalConnections and RemoteConnections, for collect_metrics
+managers = []
+metrics.collectors.append(collect_metrics)
+metrics.describe("link_lines_in", "counter",
+ "Lines received from servers, by command.", "command")
+metrics.describe("link_lines_out", "counter",
+ "Lines sent to servers, by command.", "command")
+metrics.describe("link_duplicates", "counter",
+ "Server lines dropped because their event id was seen before, by command.",
+ "command")
+metrics.describe("link_handler_seconds", "histogram",
+ "Time spent in server command handlers, by command.", "command")
+metrics.describe("burst_seconds", "histogram",
+ "Time taken by netbursts: building one to send, receiving one from BURST "
+ "to EOB, and applying it.", "phase")
+metrics.describe("users", "gauge", "Users known to the gateway.")
+metrics.describe("local_users", "gauge", "Users connected to the gateway.")
+metrics.describe("channels", "gauge", "Channels.")
+metrics.describe("servers", "gauge", "Server links.")
+metrics.describe("connections", "gauge", "Open connections, by kind.", "kind")
+metrics.describe("sendq_bytes", "gauge",
+ "Bytes waiting in send queues, by connection kind.", "kind")
+metrics.describe("sendq_max_bytes", "gauge",
+ "Deepest send queue, by connection kind.", "kind")
+metrics.describe("link_bytes_in", "counter",
+ "Bytes received on each open server link.", "link")
+metrics.describe("link_bytes_out", "counter",
+ "Bytes sent on each open server link.", "link")
+metrics.describe("link_sendq_bytes", "gauge",
+ "Bytes waiting in the send queue of each server link.", "link")
+
+def flush_pending ():
+	"""sends everything queued during this loop iteration"""
+	while pending:
+		pending.pop().flush()
+
+class Connection ():
+	"""socket plumbing shared by client and server connections: a bounded
+	outbound queue flushed as the socket becomes writable, and deferred
+	teardown through the owning manager"""
+	def __init__ (self, manager, socket, sendq_max):
+		self.manager = manager
+		self.sock = socket
+		self.sock.setblocking(0)
+		self.logger = manager.logger
+		self.closed = False
+		self.sendq = deque()
+		# encoded data a send() did not take all of; it goes out before
+		# anything in sendq
+		self.partial = ""
+		self.sendq_len = 0
+		self.sendq_max = sendq_max
+		self.lines_in = 0
+		self.lines_out = 0
+		self.bytes_out = 0
+		self.started = time.time()
+		self.lastseen = time.time()
+		self.pinged = False
+		self.timer = manager.events.call_later(manager.ping_interval,
+		 self.keepalive)
+
+	def keepalive (self):
+		"""timer callback: pings the peer once it has been idle for
+		ping_interval, and closes it if it does not answer within
+		ping_timeout; reads only update lastseen, the timer looks at it
+		when it fires"""
+		if self.closed:
+			return
+		idle = time.time() - self.lastseen
+		if idle < self.manager.ping_interval:
+			self.timer = self.manager.events.call_later(
+			 self.manager.ping_interval - idle, self.keepalive)
+		elif not self.pinged:
+			self.ping()
+			self.pinged = True
+			self.timer = self.manager.events.call_later(
+			 self.manager.ping_timeout, self.keepalive)
+		elif self.expects_pong():
+			try:
+				self.error("Ping timeout: %d seconds" % idle)
+			except socket.error:
+				pass
+		else:
+			self.pinged = False
+			self.timer = self.manager.events.call_later(
+			 self.manager.ping_interval, self.keepalive)
+
+	def expects_pong (self):
+		return True
 
-		for connection in self.connections:
+	def write (self, data):
+		"""sends raw data right away, queueing whatever does not fit"""
+		if self.closed:
+			return
+		if not self.sendq and not self.partial:
 			try:
-				connection.sock.type
-				connection.loop()
+				sent = self.sock.send(data)
 			except socket.error as e:
-				if e.errno == EAGAIN:
-					continue
-				for nick in connection.users:
-					del users[nick]
-				servers.remove(connection)
-				self.connections.remove(connection)
+				if e.errno not in (EAGAIN, EWOULDBLOCK):
+					self.close(os.strerror(e.errno) if e.errno else e.message)
+					return
+				sent = 0
+			self.bytes_out += sent
+			if sent == len(data):
+				self.lines_out += 1
+				return
+			data = data[sent:]
+		self.queue(data)
 
-		# args[1 - fp , 2 - host , 3 - port , 4 - gecos]
-		if self.socket_queue:
+	def queue (self, data):
+		"""queues raw data to be sent by flush_pending at the end of this
+		loop iteration or when the socket becomes writable"""
+		if self.closed:
+			return
+		if not self.sendq:
+			pending.add(self)
+		self.lines_out += 1
+		self.sendq.append(data)
+		self.sendq_len += len(data)
+		if self.sendq_len > self.sendq_max:
+			# the backlog may be no more than this iteration's output (a
+			# burst, say), so the socket gets to take what it can first
+			self.flush()
+			if self.closed or self.sendq_len <= self.sendq_max:
+				return
+			self.sendq.clear()
+			self.partial = ""
+			self.sendq_len = 0
+			self.close("SendQ exceeded")
+
+	def encode (self, data):
+		"""turns queued data into what goes on the wire"""
+		return data
+
+	def take (self):
+		"""takes up to 64 KiB off sendq and encodes it"""
+		if len(self.sendq) == 1:
+			plain = self.sendq.popleft()
+		else:
+			chunk = []
+			size = 0
+			while self.sendq and size < 65536:
+				chunk.append(self.sendq.popleft())
+				size += len(chunk[-1])
+			plain = "".join(chunk)
+		data = self.encode(plain)
+		self.sendq_len += len(data) - len(plain)
+		return data
+
+	def flush (self):
+		"""sends queued data, up to 64 KiB per system call"""
+		while (self.partial or self.sendq) and not self.closed:
+			if self.partial:
+				data = self.partial
+				self.partial = ""
+			else:
+				data = self.take()
 			try:
-				args = self.socket_queue.pop(0)
-				self.logger.log_line("DEBUG",
-				 "creating new connection to %s:%s" % (args[2], args[3]))
-				sock = socket.socket
-				sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-				address = (args[2], int(args[3]))
-				sock.connect(address)
-				# todo: we need to setblocking before connect
-				# todo: with ssl check against socket_queue[1]
-				# todo: gecos
-				sock.setblocking(0)
-				conn = RemoteConnection(
-				 sock,
-				 address,
-				 self.socket_queue,
-				 self.logger)
-
-				conn.send("SERVER %s %s %d :%s" %
-				 ("*",
-				 self.hostname,
-				 self.bind_port,
-				 "PRC gateway"))
-
-				self.connections.append(conn)
-				servers.append(conn)
+				sent = self.sock.send(data)
+			except socket.error as e:
+				if e.errno not in (EAGAIN, EWOULDBLOCK):
+					self.close(os.strerror(e.errno) if e.errno else e.message)
+					return
+				sent = 0
+			self.sendq_len -= sent
+			self.bytes_out += sent
+			if sent < len(data):
+				self.partial = data[sent:]
+				self.manager.events.set_writable(self.sock, True)
+				return
+		if not self.closed:
+			self.manager.events.set_writable(self.sock, False)
 
+	def close (self, message):
+		"""closes the socket and schedules the teardown"""
+		if self.closed:
+			return
+		if self.partial or self.sendq:
+			# one last try, so ERROR lines have a chance to get out
+			try:
+				self.sock.send(self.partial + self.encode("".join(self.sendq)))
 			except socket.error:
-				pass # todo
+				pass
+		self.closed = True
+		self.timer.cancel()
+		# live connections are added in when the metrics are read
+		metrics.count("bytes_in", self.kind, self.linebuf.received)
+		metrics.count("bytes_out", self.kind, self.bytes_out)
+		self.manager.events.unregister(self.sock)
+		self.sock.close()
+		self.manager.prune.append((self, message))
 
-		# check connection queue
-		try:
-			sock, address = self.sock.accept()
-			conn = RemoteConnection(
-			 sock,
-			 None,
-			 self.socket_queue,
-			 self.logger)
-			self.connections.append(conn)
-			servers.append(conn)
-		except socket.error:
-			pass # todo
-
-class LocalConnection ():
+class LocalConnection (Connection):
 	# one nick per connection
-	def __init__ (self, name, socket, address, olines, motdfile, logger):
-		self.name = name
-		self.sock = socket
-		self.sock.setblocking(0)
-		self.olines = olines
-		self.logger = logger
-		self.data_in = ""
-		self.lastseen = time.time()
-		self.pinged = False
-		self.motdfile = motdfile
+	kind = "client"
+
+	def __init__ (self, manager, socket, address):
+		Connection.__init__(self, manager, socket, manager.sendq)
+		self.name = manager.name
+		self.olines = manager.olines
+		self.linebuf = linebuf.LineBuffer(manager.linelen)
+		self.motdfile = manager.motdfile
 		self.user = user.User(
-		 socket = self.sock,
-		 address = address,
+		 conn = self,
+		 host = address[0],
 		 local = True,
 		 nick = "*",
-		 ident = "*",
-		 logger = self.logger,
-		 localconn = self)
+		 ident = "*")
 		
 		self.registered = 0
 
 	def send (self, message):
 		"""sends a line to the user"""
-		try:
-			self.user.send(message)
-		except socket.error:
-			self.logger.log_line("DEBUG", "sending data to a dead sock %s" %
-			 self.user.address[0])
-			self.sock.close()
+		self.user.send(message)
+
+	def send_notice (self, message):
+		"""sends a server notice to the user"""
+		self.send(":%s NOTICE %s :%s" % (self.name, self.user.nick, message))
 
 	def send_numeric (self, numeric, message = None):
 		"""sends a numeric to the user"""
@@ -278,13 +816,33 @@ class LocalConnection ():
 	def error (self, message):
 		"""closes the connection after sending a message with reason"""
 		self.send("ERROR :%s" % message)
-		self.sock.close()
+		self.close(message)
 		raise socket.error, message
 
-	def broadcast_remote (self, line):
-		"""broadcasts a message to all connected remote servers"""
+	def broadcast_remote (self, line, interested = None):
+		"""broadcasts a message to all connected remote servers; if the set
+		of links interested in it is given, links that route by interest
+		only get it if they are in there"""
+		tagged = None
+		for s in servers:
+			if interested is None or not s.routed or s in interested:
+				if s.tagged and tagged is None:
+					tagged = message.tag(line)
+				s.send(tagged if s.tagged else line)
+
+	def broadcast_channel (self, chan, line, sent = None):
+		"""sends JOIN/PART to the links Channel.send did not (sent, if not
+		the links of the members now): of the rest, links that route by
+		interest only get it if they want the channel"""
+		tagged = None
+		name = chan.key
+		if sent is None:
+			sent = chan.unique
 		for s in servers:
-			s.send(line)
+			if s not in sent and (not s.routed or name in s.wants):
+				if s.tagged and tagged is None:
+					tagged = message.tag(line)
+				s.send(tagged if s.tagged else line)
 
 	def send_motd (self):
 		try:
@@ -302,9 +860,9 @@ class LocalConnection ():
 		 "prcd-v1" % (self.name))
 		self.send_numeric(004, "%s prcd-v1 aBcsw abehiklmoptv" %
 		 (self.name))
-		self.send_numeric(005, "CASEMAPPING=ASCII CHANMODES=beI,k,l,imprstu "
+		self.send_numeric(005, "CASEMAPPING=%s CHANMODES=beI,k,l,imprstu "
 		 "CHANNELLEN=? CHANTYPES=#&+ EXCEPTS=e INVEX=I "
-		 ":are supported by this server")
+		 ":are supported by this server" % casemap.name)
 		self.send_numeric(005, "NETWORK=PRC NICKLEN=? PREFIX=(aohv)!@%+ "
 		 ":are supported by this server")
 		self.send_motd()
@@ -324,7 +882,7 @@ class LocalConnection ():
 				self.send_numeric(461, "%s :Erroneous username" % args[1])
 				return
 		self.registered |= 2
-		self.user.ident = args[1]
+		self.user.set_ident(args[1])
 		self.user.gecos = args[4]
 		if self.registered == 3:
 			self.send_welcome()
@@ -343,35 +901,27 @@ class LocalConnection ():
 		if args[1] == self.user.nick:
 			return
 
-		if (args[1].lower() in users and
-		 args[1].lower() != self.user.nick.lower()):
+		key = casemap.fold(args[1])
+		if key in users and key != self.user.key:
 			self.send_numeric(433, "%s :Nickname already in use" % args[1])
 			return
 
 		if self.registered >= 3:
 			self.user.send(":%s NICK %s" % (self.user.full_hostmask(), args[1]))
-			self.broadcast_remote(":%s NICK %s" %
-			 (self.user.full_hostmask(), args[1]))
 
-			for u in users.itervalues():
-				if not u.local or u == self.user:
-					continue
-				else:
-					found = False
-					for c in self.user.channels:
-						if u in channels[c].members:
-							found = True
-							break
-				if found:
-					u.send(":%s NICK %s" %
-					 (self.user.full_hostmask(), args[1]))
+			for u in self.user.neighbours:
+				u.send(":%s NICK %s" %
+				 (self.user.full_hostmask(), args[1]))
 
 			self.broadcast_remote(":%s NICK %s" %
 			 (self.user.full_hostmask(), args[1]))
-			del users[self.user.nick.lower()]
+			del users[self.user.key]
 
-		self.user.nick = args[1]
-		users[self.user.nick.lower()] = self.user
+		oldkey = self.user.key
+		self.user.set_nick(args[1])
+		users[self.user.key] = self.user
+		for c in self.user.channels:
+			channels[c].rename_user(self.user, oldkey)
 
 		self.registered |= 1
 		if self.registered == 3:
@@ -379,33 +929,38 @@ class LocalConnection ():
 
 	def on_away (self, args):
 		"""AWAY command"""
+		# only links with users who can see us in a channel care
+		interested = set()
+		for c in self.user.channels:
+			interested.update(channels[c].unique)
 		if len(args) > 1: # setting away
 			self.send_numeric(306, ":Now away")
 			self.broadcast_remote(":%s AWAY :%s" %
-			 (self.user.full_hostmask(), args[1]))
+			 (self.user.full_hostmask(), args[1]), interested)
 			self.user.away = args[1]
 		else: # setting back
 			self.send_numeric(305, ":Welcome back")
 			self.broadcast_remote(":%s AWAY" %
-			 self.user.full_hostmask())
+			 self.user.full_hostmask(), interested)
 			self.user.away = None
 
 	def on_message (self, args):
 		"""PRIVMSG/NOTICE commands"""
 		type = args[0].upper()
-		target = args[1].lower()
+		target = casemap.fold(args[1])
 		message = args[2]
 		assert type in ["PRIVMSG", "NOTICE"]
 
 		if not message and type == "PRIVMSG":
-			self.send_numeric(412, "%s :No text to send" % target)
+			self.send_numeric(412, "%s :No text to send" % args[1])
 			return
 
 		if target in channels:
-			if channels[target].get_channeluser(self.user) == None or ("m" in channels[target].modeflags and channels[target].get_channeluser(self.user).status == 0):
+			member = channels[target].get_channeluser(self.user)
+			if member == None or ("m" in channels[target].modeflags and member.status == 0):
 				if type == "PRIVMSG":
 					self.send_numeric(404, "%s :Cannot send to channel" %
-					 target)
+					 args[1])
 				return
 			channels[target].send_message(self.user, type, message)
 
@@ -420,45 +975,48 @@ class LocalConnection ():
 
 		if target in users:
 			users[target].send(":%s %s %s :%s" % (self.user.full_hostmask(),
-			 type, target, message))
+			 type, users[target].nick, message))
 			return
 
 		if type == "PRIVMSG":
-			self.send_numeric(401, "%s :No such target" % target)
+			self.send_numeric(401, "%s :No such target" % args[1])
 
 	def on_topic (self, args):
 		"""TOPIC command"""
-		target = args[1].lower()
+		target = casemap.fold(args[1])
 
-		if target not in channels or channels[target].get_channeluser(self.user) == None:
-			self.send_numeric(403, "%s :No such channel" % target)
+		member = channels[target].get_channeluser(self.user) if target in channels else None
+		if member == None:
+			self.send_numeric(403, "%s :No such channel" % args[1])
 			return
 
 		if len(args) > 2:
-			if ("t" in channels[target].modeflags and channels[target].get_channeluser(self.user).status < 2):
-				self.send_numeric(482, "%s :Mode +t set" % (target))
+			if ("t" in channels[target].modeflags and member.status < 2):
+				self.send_numeric(482, "%s :Mode +t set" %
+				 channels[target].name)
 				return
 			message = args[2]
 			channels[target].change_topic(self.user, message)
 			return
 
-		self.send_numeric(332, "%s :%s" % (target, channels[target].topic))
+		self.send_numeric(332, "%s :%s" % (channels[target].name,
+		 channels[target].topic))
 
 	def on_invite (self, args):
 		"""INVITE command"""
-		target = args[1].lower()
-		channel = args[2].lower()
+		target = casemap.fold(args[1])
+		channel = casemap.fold(args[2])
 
 		if target not in users:
-			self.send_numeric(401, "%s :No such target" % target)
+			self.send_numeric(401, "%s :No such target" % args[1])
 			return
 
 		if channel not in channels:
-			self.send_numeric(403, "%s :No such channel" % channel)
+			self.send_numeric(403, "%s :No such channel" % args[2])
 			return
 
 		users[target].send(":%s INVITE %s :%s" % (self.user.full_hostmask(),
-		 target, channel))
+		 users[target].nick, channels[channel].name))
 
 	def on_join (self, args):
 		"""JOIN command"""
@@ -467,23 +1025,29 @@ class LocalConnection ():
 			newchan = False
 			if not Target:
 				continue
-			target = Target.lower()
+			target = casemap.fold(Target)
 			if target == "0":
 				for i in self.user.channels[:]:
-					channels[i].part_user(
+					chan = channels[i]
+					sent = set(chan.unique)
+					chan.part_user(
 						user = self.user,
 						message = "Left all channels")
-					if (not channels[i].members and not
-					 channels[i].immutable):
+					if not chan.members and not chan.immutable:
 						del channels[i]
+					if i[0] != "&":
+						self.broadcast_channel(chan, ":%s PART %s :%s" %
+						 (self.user.full_hostmask(), chan.name,
+						 "Left all channels"), sent)
 				continue
 			if target[0] not in "+&#":
 				self.send_numeric(403, "%s :No such channel" % Target)
 				continue
 			if not target in channels:
 				channels[target] = channel.Channel(Target)
-				newchan = True
-			if channels[target].get_channeluser(self.user) in channels[target].members:
+				# channels other gateways want are not new to the network
+				newchan = not network_wants(target)
+			if self.user in channels[target].members:
 				continue
 			if (target in ("&errors", "&eval", "&rawlog") and self.olines and
 			 not self.user.isoper) or channels[target].is_really_banned(self.user) or ("i" in channels[target].modeflags and not channels[target].is_invex(self.user)):
@@ -494,26 +1058,35 @@ class LocalConnection ():
 			else:
 				channels[target].join_user(self.user, self)
 			if target[0] != "&":
-				self.broadcast_remote(":%s JOIN %s" %
-				 (self.user.full_hostmask(), target))
+				self.broadcast_channel(channels[target], ":%s JOIN %s" %
+				 (self.user.full_hostmask(), channels[target].name))
 
 	def on_part (self, args):
 		"""PART command"""
-		targets = args[1].lower().split(",")
-		for target in targets:
+		targets = args[1].split(",")
+		for Target in targets:
+			target = casemap.fold(Target)
 			if not target in channels:
-				self.send_numeric(403, "%s :No such channel" % target)
+				self.send_numeric(403, "%s :No such channel" % Target)
 				return
-			channels[target].part_user(
+			chan = channels[target]
+			if self.user not in chan.members:
+				self.send_numeric(442, "%s :You're not on that channel" %
+				 chan.name)
+				continue
+			sent = set(chan.unique)
+			chan.part_user(
 			 user = self.user,
 			 message = args[2] if len(args) > 2 else None)
-			if (not channels[target].members and not
-			 channels[target].immutable):
+			if not chan.members and not chan.immutable:
 				del channels[target]
-			self.broadcast_remote(":%s PART %s%s" %
+			self.broadcast_channel(chan, ":%s PART %s%s" %
 			 (self.user.full_hostmask(),
-			 target,
-			 " :" + args[2] if len(args) > 2 else ""))
+			 chan.name,
+			 " :" + args[2] if len(args) > 2 else ""), sent)
+
+	def ping (self):
+		self.user.send("PING :%s" % self.name)
 
 	def on_ping (self, args):
 		"""PING command; makes lag-checking clients happy"""
@@ -545,10 +1118,167 @@ class LocalConnection ():
 		if self.olines and not self.user.isoper:
 			self.send_numeric(481, ":Permission denied")
 		else:
-			target = args[1].lower()
+			target = casemap.fold(args[1])
 			if target in users and users[target].local:
-				users[target].localconn.error("Killed by " + self.user.nick + ": " + args[2])
+				try:
+					users[target].conn.error("Killed by " + self.user.nick + ": " + args[2])
+				except socket.error:
+					pass
 		
+	def on_tap (self, args):
+		"""TAP command; configures the &rawlog and &errors feeds
+
+		TAP <channel> FILTER <command|nick|link> [value[,value...]]
+		TAP <channel> SAMPLE <one in n lines>
+		TAP <channel> REPLAY [count]"""
+		if self.olines and not self.user.isoper:
+			self.send_numeric(481, ":Permission denied")
+			return
+		target = casemap.fold(args[1])
+		if target not in channels or not isinstance(channels[target],
+		 channel.TapChannel):
+			self.send_numeric(403, "%s :No such channel" % args[1])
+			return
+		tap = channels[target]
+		action = args[2].upper() if len(args) > 2 else ""
+
+		if action == "FILTER" and len(args) > 3:
+			if args[3].lower() not in tap.filter_types:
+				self.send_numeric(461, "TAP :Filter on command, nick or link")
+				return
+			tap.set_filter(args[3].lower(),
+			 args[4].split(",") if len(args) > 4 else None)
+		elif action == "SAMPLE" and len(args) > 3 and args[3].isdigit():
+			tap.sample = max(int(args[3]), 1)
+		elif action == "REPLAY":
+			tap.replay(self.user, int(args[3]) if len(args) > 3 and
+			 args[3].isdigit() else len(tap.backlog or ()))
+			return
+		elif action:
+			self.send_numeric(461, "TAP :Unknown TAP command")
+			return
+
+		self.send_notice("%s: sampling 1 in %d, backlog %d, filters %s" %
+		 (tap.name, tap.sample, len(tap.backlog or ()),
+		 ", ".join("%s=%s" % (type, ",".join(sorted(values)))
+		 for type, values in sorted(tap.filters.iteritems())) or "none"))
+
+	def on_stats (self, args):
+		"""STATS command; oper-only view of the metrics
+
+		STATS m    lines in and out and handler time, per command
+		STATS l    traffic and send queue of each server link
+		STATS g    users, channels, connections, bytes and loop time
+		STATS o    connection, user and channel objects still alive"""
+		if self.olines and not self.user.isoper:
+			self.send_numeric(481, ":Permission denied")
+			return
+		query = args[1].lower() if len(args) > 1 else "g"
+		values = metrics.collect()
+
+		if query == "m":
+			for command in sorted(set(label for name, label in values
+			 if name in ("lines_in", "lines_out"))):
+				handler = metrics.histograms.get(("handler_seconds", command))
+				self.send_numeric(212, "%s %d %d :%s" % (command,
+				 values.get(("lines_in", command), 0),
+				 values.get(("lines_out", command), 0),
+				 "%.1f us avg, p99 under %s s" % (
+				 handler.sum / handler.count * 1e6, handler.quantile(0.99))
+				 if handler else "no handler time"))
+
+		elif query == "l":
+			now = time.time()
+			for server in servers:
+				self.send_numeric(211, "%s %d %d %d %d %d %d" % (
+				 link_name(server), server.sendq_len, server.lines_out,
+				 server.bytes_out / 1024, server.lines_in,
+				 server.linebuf.received / 1024, now - server.started))
+
+		elif query == "g":
+			loop = metrics.histograms.get(("loop_seconds", None))
+			for line in (
+			 "users %d (%d local), channels %d, servers %d" % (
+			 values[("users", None)], values[("local_users", None)],
+			 values[("channels", None)], values[("servers", None)]),
+			 "bytes in %d clients, %d servers; out %d clients, %d servers" % (
+			 values.get(("bytes_in", "client"), 0),
+			 values.get(("bytes_in", "server"), 0),
+			 values.get(("bytes_out", "client"), 0),
+			 values.get(("bytes_out", "server"), 0)),
+			 "sendq %d bytes clients (deepest %d), %d bytes servers "
+			 "(deepest %d)" % (
+			 values.get(("sendq_bytes", "client"), 0),
+			 values.get(("sendq_max_bytes", "client"), 0),
+			 values.get(("sendq_bytes", "server"), 0),
+			 values.get(("sendq_max_bytes", "server"), 0)),
+			 "duplicate server lines dropped %d" % sum(value
+			 for (name, label), value in values.iteritems()
+			 if name == "link_duplicates"),
+			 "loop %d iterations, p50 under %s s, p99 under %s s" % (
+			 loop.count, loop.quantile(0.5), loop.quantile(0.99))
+			 if loop else "loop not timed yet"):
+				self.send_numeric(249, "g :%s" % line)
+
+		elif query == "o":
+			# counted off the collector's list of objects, so ones kept
+			# alive by nothing but a reference cycle show up too
+			live = dict.fromkeys(("LocalConnection", "RemoteConnection",
+			 "User", "Channel", "ChannelUser"), 0)
+			for obj in gc.get_objects():
+				if isinstance(obj, (Connection, user.User, channel.Channel,
+				 channel.ChannelUser)):
+					name = obj.__class__.__name__
+					if name in live:
+						live[name] += 1
+			for name in sorted(live):
+				self.send_numeric(249, "o :%s %d" % (name, live[name]))
+
+		self.send_numeric(219, "%s :End of STATS report" % query)
+
+	def on_profile (self, args):
+		"""PROFILE command; profiles the running gateway for a while, writes
+		the profile to a file and sends back the hottest functions
+
+		PROFILE START [seconds] [sample|cprofile] [top n]
+		PROFILE STOP"""
+		if self.olines and not self.user.isoper:
+			self.send_numeric(481, ":Permission denied")
+			return
+		action = args[1].upper()
+
+		if action == "STOP":
+			if not self.manager.profile:
+				self.send_notice("no profile is running")
+				return
+			self.manager.stop_profile()
+
+		elif action == "START":
+			if self.manager.profile:
+				self.send_notice("a profile is already running")
+				return
+			try:
+				seconds = min(int(args[2]), 600) if len(args) > 2 else 30
+				count = int(args[4]) if len(args) > 4 else 15
+			except ValueError:
+				self.send_numeric(461, ":Too few arguments")
+				return
+			mode = args[3].lower() if len(args) > 3 else "sample"
+			if mode not in ("sample", "cprofile"):
+				self.send_notice("profile mode must be sample or cprofile")
+				return
+			try:
+				self.manager.start_profile(self, mode, seconds, count)
+			except (IOError, OSError) as e:
+				self.send_notice("cannot profile: %s" % e)
+				return
+			self.send_notice("%s profile running for %d seconds" %
+			 (mode, seconds))
+
+		else:
+			self.send_notice("PROFILE START [seconds] [sample|cprofile] "
+			 "[top n] or PROFILE STOP")
+
 	def on_die (self, args):
 		"""DIE command; kills the server"""
 		if self.olines and not self.user.isoper:
@@ -559,43 +1289,42 @@ class LocalConnection ():
 
 	def on_who (self, args):
 		"""WHO command"""
-		target = args[1].lower()
+		target = casemap.fold(args[1])
 
 		if target in channels:
-			targets = channels[target].members
+			targets = channels[target].members.keys()
 		elif target in users:
 			targets = [users[target]]
 		else:
-			self.send_numeric(315, "%s :End of WHO" % target)
+			self.send_numeric(315, "%s :End of WHO" % args[1])
 			return
 
 		for u in targets:
 			self.send_numeric(352, " ".join( (
-			 target,
-			 u.user.ident,
-			 u.user.address[0],
+			 args[1],
+			 u.ident,
+			 u.host,
 			 self.name,
-			 u.user.nick,
-			 ("G" if u.user.away else "H") +
-			 ("*" if u.user.isoper else ""),
-			 ":0" if u.user.local else ":1",
-			 u.user.gecos
+			 u.nick,
+			 ("G" if u.away else "H") +
+			 ("*" if u.isoper else ""),
+			 ":0" if u.local else ":1",
+			 u.gecos
 			 ) ))
 
-		self.send_numeric(315, "%s :End of WHO" % target)
+		self.send_numeric(315, "%s :End of WHO" % args[1])
 
 	def on_whois (self, args):
 		"""WHOIS command"""
-		targets = args[-1].lower().split(",")
-
-		for target in targets:
+		for Target in args[-1].split(","):
+			target = casemap.fold(Target)
 			if target not in users:
-				self.send_numeric(401, "%s :No such nick" % target)
+				self.send_numeric(401, "%s :No such nick" % Target)
 				continue
 			self.send_numeric(311, "%s %s %s * :%s" %
 			 (users[target].nick,
 			 users[target].ident,
-			 users[target].address[0],
+			 users[target].host,
 			 users[target].gecos))
 			#self.send_numeric(312, "%s %s :%s" %
 			# (users[target].nick,
@@ -614,10 +1343,10 @@ class LocalConnection ():
 		self.send_numeric(318, "%s :End of WHOIS" % args[-1])
 
 	def on_names (self, args):
-		channel = args[1].lower()
+		channel = casemap.fold(args[1])
 
 		if channel not in channels:
-			self.send_numeric(403, "%s :No such channel" % target)
+			self.send_numeric(403, "%s :No such channel" % args[1])
 			return
 
 		channels[channel].send_names(self)
@@ -631,23 +1360,24 @@ class LocalConnection ():
 		self.send_numeric(365, "%s :End of LINKS" %
 		 (args[1] if len(args) > 1 else "*"))
 	def on_mode (self, args):
-		if args[1].lower() == self.user.nick.lower() or args[1][0] == "+":
+		target = casemap.fold(args[1])
+		if target == self.user.key or target[0] == "+":
 			self.on_umode(args)
 			return
 		modes = args[2] if len(args) > 2 else ""
 		if modes == "": return
-		target = args[1].lower()
-		if not target in channels or target[0] == "+":
-			self.send_numeric(401, "%s :No such target" % target)
+		if not target in channels:
+			self.send_numeric(401, "%s :No such target" % args[1])
 			return
-		if not channels[target].get_channeluser(self.user):
-			self.send_numeric(404, "%s :Cannot send to channel" % target)
+		me = channels[target].get_channeluser(self.user)
+		if not me:
+			self.send_numeric(404, "%s :Cannot send to channel" % args[1])
 			return
 		mode_param = 3
 		SET = True
 		UNSET = False
 		action = SET
-		mystatus = channels[target].get_channeluser(self.user).status
+		mystatus = me.status
 		for mode in modes:
 			if mode == "+":
 				action = SET
@@ -667,27 +1397,27 @@ class LocalConnection ():
 				continue
 			if mode in "beI" and len(args) == 3:
 				for ban in channels[target].blist[mode]:
-					self.send_numeric(367, "%s %s" % (target, ban))
+					self.send_numeric(367, "%s %s" % (channels[target].name, ban))
 				listType = { "I": "invite exception", "b": "ban", "e": "ban exception" }
-				self.send_numeric(368, "%s :End of %s list" % (target, listType[mode]))
+				self.send_numeric(368, "%s :End of %s list" % (channels[target].name, listType[mode]))
 				continue
 			if mode_param >= len(args):
 				return
 			if mode in "beI" and mystatus > 1:
-				targetmask = args[mode_param]
+				targetmask = casemap.fold(args[mode_param])
 				mode_param += 1
-				if (action == SET and not targetmask.lower() in channels[target].blist[mode]) or (action == UNSET and targetmask.lower() in channels[target].blist[mode]):
+				if (action == SET and not targetmask in channels[target].blist[mode]) or (action == UNSET and targetmask in channels[target].blist[mode]):
 					if action == SET:
-						channels[target].blist[mode].add(targetmask.lower())
+						channels[target].add_mask(mode, targetmask)
 					else:
-						channels[target].blist[mode].remove(targetmask.lower())
-					channels[target].send_mode_change(self.user,"+%s %s" % (mode, targetmask.lower()))
+						channels[target].remove_mask(mode, targetmask)
+					channels[target].send_mode_change(self.user,"+%s %s" % (mode, targetmask))
 				continue
 			if mode in "aohv" and mystatus >= channels[target].mode_to_status(mode):
 				targetuser = args[mode_param]
 				mode_param += 1
-				if not channels[target].get_userbyname(targetuser): continue
 				targetuser = channels[target].get_userbyname(targetuser)
+				if not targetuser: continue
 				if action == SET:
 					if targetuser.status >= channels[target].mode_to_status(mode):
 						continue
@@ -701,20 +1431,21 @@ class LocalConnection ():
 			self.send_numeric(472, "%s :is an unknown mode to me" % mode)
 		return
 	def on_kick (self, args):
-		channel = args[1].lower()
-		target = args[2].lower()
+		channel = casemap.fold(args[1])
 		message = args[3] if len(args) > 3 else "Kicked"
 		if not channel in channels or channel[0] == "+":
-			self.send_numeric(401, "%s :No such target" % channel)
+			self.send_numeric(401, "%s :No such target" % args[1])
 			return
-		if channels[channel].get_channeluser(self.user) == None or channels[channel].get_channeluser(self.user).status < 2 or channels[channel].get_userbyname(target) == None or channels[channel].get_userbyname(target).status > channels[channel].get_channeluser(self.user).status:
-			self.send_numeric(482, "%s :Operation not permitted" % (target))
+		me = channels[channel].get_channeluser(self.user)
+		victim = channels[channel].get_userbyname(args[2])
+		if me == None or me.status < 2 or victim == None or victim.status > me.status:
+			self.send_numeric(482, "%s :Operation not permitted" % (args[2]))
 			return
-		channels[channel].kick_user(channels[channel].get_channeluser(self.user), channels[channel].get_userbyname(target), message)
+		channels[channel].kick_user(me, victim, message)
 
 	def on_umode (self, args):
 		"""MODE command"""
-		target = args[1].lower()
+		target = casemap.fold(args[1])
 		modes = args[2] if len(args) > 2 else ""
 
 		add = True
@@ -741,142 +1472,175 @@ class LocalConnection ():
 		elif catch:
 			return
 
-		if target == self.user.nick.lower():
+		if target == self.user.key:
 			modes = "+"
 			modes += "o" if self.user.isoper else ""
 			self.send_numeric(221, modes)
 			return
 
 		if target in channels:
-			self.send_numeric(477, "%s :Channel doesn't support modes" % target)
+			self.send_numeric(477, "%s :Channel doesn't support modes" % args[1])
 			return
 
 		if target in users:
 			self.send_numeric(502, "Snooping through others' usermodes is bad!")
 			return
 
-		self.send_numeric(401, "%s :No such target" % target)
+		self.send_numeric(401, "%s :No such target" % args[1])
 
 	def on_unimplemented (self, args):
 		"""Commands that we don't want to give errors on but we still want to
 		recognise"""
 		pass
 
-	def irc_callback (self, command, line, min_args, cb, pre_register = False):
-		if command != line[0].upper():
-			return False
+	# command: (min_args, handler, pre_register)
+	commands = {
+		"USER": (4, on_user, True),
+		"NICK": (1, on_nick, True),
+		"AWAY": (0, on_away, False),
+		"PRIVMSG": (2, on_message, False),
+		"NOTICE": (2, on_message, False),
+		"TOPIC": (1, on_topic, False),
+		"INVITE": (2, on_invite, False),
+		"JOIN": (1, on_join, False),
+		"PART": (1, on_part, False),
+		"MOTD": (0, on_motd, True),
+		"PING": (1, on_ping, False),
+		"QUIT": (0, on_quit, True),
+		"KICK": (2, on_kick, False),
+		"OPER": (2, on_oper, False),
+		"DIE": (0, on_die, False),
+		"WHO": (1, on_who, False),
+		"WHOIS": (1, on_whois, False),
+		"NAMES": (1, on_names, False),
+		"LINKS": (0, on_links, False),
+		"MODE": (1, on_mode, False),
+		"KILL": (2, on_kill, False),
+		"TAP": (1, on_tap, False),
+		"STATS": (0, on_stats, False),
+		"PROFILE": (1, on_profile, False),
+		"PONG": (0, on_unimplemented, True),
+		"CAP": (0, on_unimplemented, True),
+	}
+
+	def irc_callback (self, msg):
+		try:
+			min_args, cb, pre_register = self.commands[msg.command]
+		except KeyError:
+			metrics.count("lines_in", "unknown")
+			self.send_numeric(421, "%s :Unknown command" % msg.command)
+			return
+		metrics.count("lines_in", msg.command)
 
 		if not pre_register and self.registered < 3:
 			self.send_numeric(451, ":Connection not registered")
-			return True
+			return
 
-		if len(line) < min_args + 1:
+		if len(msg.args) < min_args + 1:
 			self.send_numeric(461, ":Too few arguments")
-			return True
-
-		args = line
-
-		for i in xrange(len(line)):
-			if line[i].startswith(":"):
-				args = line[:i] + [" ".join(line[i:])[1:]]
-				break
+			return
 
-		cb(args)
-		return True
+		start = time.time()
+		cb(self, msg.args)
+		metrics.observe("handler_seconds", msg.command, time.time() - start)
 
 	def handle_line (self, line):
-		channels["&rawlog"].send_message(None, "PRIVMSG",
-		 self.user.nick + " " + line)
-		line = line.split(" ")
-		if not line:
-			return
-
-		for i in (
-			#(command, min_args, cb, pre_register = False)
-			("USER", 4, self.on_user, True),
-			("NICK", 1, self.on_nick, True),
-			("AWAY", 0, self.on_away),
-			("PRIVMSG", 2, self.on_message),
-			("NOTICE", 2, self.on_message),
-			("TOPIC", 1, self.on_topic),
-			("INVITE", 2, self.on_invite),
-			("JOIN", 1, self.on_join),
-			("PART", 1, self.on_part),
-			("MOTD", 0, self.on_motd, True),
-			("PING", 1, self.on_ping),
-			("QUIT", 0, self.on_quit, True),
-			("KICK", 2, self.on_kick),
-			("OPER", 2, self.on_oper),
-			("DIE", 0, self.on_die),
-			("WHO", 1, self.on_who),
-			("WHOIS", 1, self.on_whois),
-			("NAMES", 1, self.on_names),
-			("LINKS", 0, self.on_links),
-			("MODE", 1, self.on_mode),
-			("KILL", 2, self.on_kill),
-			("PONG", 0, self.on_unimplemented, True),
-			("CAP", 0, self.on_unimplemented, True),
-		):
-			if self.irc_callback(i[0], line, i[1], i[2],
-			 i[3] if len(i) > 3 else False):
-				break
-		else:
-			self.send_numeric(421, "%s :Unknown command" % line[0].upper())
+		msg = message.parse(line)
+		if not msg.args:
+			return
+		rawlog.tap(self.user.nick, None, msg.command, line)
 
-	def loop (self):
-		self.data_in += self.sock.recv(512)
-		# be compatible with all shitty irc clients
-		lines = self.data_in.replace("\r\n", "\n").replace("\n\r",
-		 "\n").replace("\r", "\n").split("\n")
-		self.data_in = lines.pop()
+		self.irc_callback(msg)
 
-		for line in lines:
-			self.logger.log_line("DEBUG",
-			 "\x1b[32;1m<-\x1b[0;1m from %s\x1b[0m %s" % (self.user.nick, line))
+	def loop (self):
+		for line in self.linebuf.read(self.sock):
+			if self.closed:
+				break
+			if self.logger.debug:
+				self.logger.log("DEBUG",
+				 "\x1b[32;1m<-\x1b[0;1m from %s\x1b[0m %s", self.user.nick, line)
+			self.lines_in += 1
 			self.handle_line(line)
-			self.lastseen = time.time()
-			self.pinged = False
+		self.lastseen = time.time()
+		self.pinged = False
 
-class RemoteConnection ():
+class RemoteConnection (Connection):
 	# these are "servers" and may have more than one nick / client
-	def __init__ (self, socket, address, socket_queue, logger):
-		self.sock = socket
-		self.sock.setblocking(0)
+	kind = "server"
+
+	def __init__ (self, manager, socket, address):
+		Connection.__init__(self, manager, socket, manager.sendq)
 		self.address = address
 		self.gecos = "*"
-		self.socket_queue = socket_queue
-		self.logger = logger
-		self.data_in = ""
-		self.users = {}
-		self.logger.log_line("DEBUG", "remote %s created" %
-		 (self.address[0] if self.address else "*"))
+		self.linebuf = linebuf.LineBuffer(manager.linelen)
+		self.users = casemap.CaseMap()
+		# a link to another worker of this gateway, see add_worker()
+		self.internal = False
+		# whether the peer's CAPAB lists PING; links to gateways that do
+		# not are neither pinged nor timed out
+		self.keepalives = False
+		# we sent CAPAB, and what the peer's CAPAB listed
+		self.offered = False
+		self.capabs = set()
+		# whether the peer takes event ids
+		self.tagged = False
+		# whether the peer says which channels it wants (see on_want), and
+		# those channels
+		self.routed = False
+		self.wants = set()
+		# lines of a netburst being received, applied together at EOB
+		self.burst = None
+		self.burst_started = 0
+		# compresses what we send once the peer has agreed to it
+		self.deflater = None
+		self.logger.log("DEBUG", "remote %s created",
+		 self.address[0] if self.address else "*")
+
+	# how long the nick and mask lists of burst lines may get
+	burst_width = 400
 
 	def broadcast_local (self, user, line):
 		"""sends a remote message to local users who share at least one
 		channel with the remote user"""
-		for u in users.itervalues():
-			if not u.local:
-				continue
-			if u == user:
-				continue
-			found = False
-			for c in user.channels:
-				if u in channels[c].members:
-					found = True
-					break
-			if found:
-				u.send(":%s %s" % (user.full_hostmask(), line))
+		for u in user.neighbours:
+			u.send(":%s %s" % (user.full_hostmask(), line))
 
 	def send (self, line):
 		"""sends a line to the remote client"""
-		self.logger.log_line("DEBUG", "\x1b[31;2m>>\x1b[0;1m from %s\x1b[0m %s"
-		 % (self.address[0] if self.address else "*", line))
-		try:
-			self.sock.send("%s\n" % line)
-		except:
-			self.logger.log_line("DEBUG", "sending data to a dead sock %s" %
-			 self.address[0])
-			self.sock.close()
+		if self.logger.debug:
+			self.logger.log("DEBUG", "\x1b[31;2m>>\x1b[0;1m from %s\x1b[0m %s",
+			 self.address[0] if self.address else "*", line)
+		if line[:1] == "@" and not self.tagged:
+			line = message.untag(line)
+		metrics.count_line("link_lines_out", line)
+		# collected and written in one go by flush_pending
+		self.queue("%s\n" % line)
+
+	def encode (self, data):
+		if not self.deflater:
+			return data
+		return (self.deflater.compress(data) +
+		 self.deflater.flush(zlib.Z_SYNC_FLUSH))
+
+	def offer_capabs (self):
+		"""tells the peer which protocol extensions we speak; with ZLIB, a
+		ZIP line marks where each side's zlib stream starts"""
+		self.offered = True
+		capabs = ["BURST", "MSGID", "WANT", "PING"]
+		if self.manager.zlib_level:
+			capabs.append("ZLIB")
+			self.linebuf.marker = "ZIP"
+		self.send("CAPAB :%s" % " ".join(capabs))
+
+	def start_compressing (self):
+		self.send("ZIP")
+		# what is queued so far goes out as it is
+		self.partial += "".join(self.sendq)
+		self.sendq.clear()
+		pending.add(self)
+		self.deflater = zlib.compressobj(self.manager.zlib_level)
+		self.logger.log("INFO", "compressing link to %s",
+		 self.address[0] if self.address else "*")
 
 	def send_numeric (self, numeric, message = None):
 		"""sends a numeric to the remote client"""
@@ -886,15 +1650,101 @@ class RemoteConnection ():
 
 	def error (self, message = None):
 		self.send("ERROR :%s" % message if message else "Killed")
-		self.sock.close()
+		self.close(message)
 		raise socket.error, message
 
+	def ping (self):
+		if self.keepalives:
+			self.send("PING :%s" % (self.manager.hostname or "*"))
+
+	def expects_pong (self):
+		return self.keepalives
+
+	def on_ping (self, args):
+		"""PING command; the peer checking that we are alive"""
+		self.send("PONG :%s" % args[1])
+
+	def on_pong (self, args):
+		"""PONG command; reading it already counted as hearing from the
+		peer"""
+		pass
+
+	def on_capab (self, args):
+		"""CAPAB command; the capabilities the peer offers"""
+		if self.internal:
+			return
+		self.capabs = set(args[1].upper().split())
+		self.tagged = "MSGID" in self.capabs
+		self.routed = "WANT" in self.capabs
+		self.keepalives = "PING" in self.capabs
+		if not self.offered:
+			self.offer_capabs()
+		if ("ZLIB" in self.capabs and self.manager.zlib_level and
+		 not self.deflater):
+			self.start_compressing()
+		if self.address and "BURST" in self.capabs:
+			# we connected out, so this is the answer to our CAPAB and the
+			# peer has our hello; it gets our side of the network now
+			self.send_burst()
+
+	# commands whose first parameter may be a channel
+	channel_scoped = ("JOIN", "PART", "PRIVMSG", "NOTICE", "TOPIC", "MODE",
+	 "KICK")
+
+	def wants_line (self, msg):
+		"""whether a line relayed from a worker is of interest to the peer"""
+		if not self.routed:
+			return True
+		if (msg.command in self.channel_scoped and len(msg.args) > 1 and
+		 msg.args[1][:1] in "#+"):
+			return casemap.fold(msg.args[1]) in self.wants
+		if msg.command == "AWAY" and msg.prefix:
+			user = users.get_name(msg.prefix.partition("!")[0])
+			return not user or any(self in channels[c].unique
+			 for c in user.channels if c in channels)
+		return True
+
+	def on_want (self, args):
+		"""WANT command; the peer has users in a channel now, so it gets the
+		channel's traffic from here on and our side of it right away"""
+		target = casemap.fold(args[1])
+		self.set_wanted(target, True)
+		# worker 0, passing on its links' WANTs, has our side already
+		if target in channels and not self.internal:
+			for line in self.channel_lines(channels[target]):
+				self.send(line)
+
+	def on_unwant (self, args):
+		"""UNWANT command; the last user of the peer left a channel"""
+		self.set_wanted(casemap.fold(args[1]), False)
+
+	def set_wanted (self, target, wanted):
+		"""records whether the peer wants a channel; the workers do not
+		see the links' WANTs, so worker 0 tells them when the first link
+		starts, or the last one stops, wanting it, which JOIN needs to tell
+		a channel new to the network from one that is not"""
+		if wanted == (target in self.wants):
+			return
+		before = network_wants(target)
+		if wanted:
+			self.wants.add(target)
+		else:
+			self.wants.discard(target)
+		if not self.internal and network_wants(target) != before:
+			for conn in self.manager.workers:
+				conn.send("%s %s" % ("WANT" if wanted else "UNWANT", target))
+
+	def on_zip (self, args):
+		"""ZIP command; the line buffer has already switched to inflating"""
+		pass
+
 	# SERVER ssl-sha256-fingerprint host port :gecos
 	def on_server (self, args):
 		"""SERVER command that registers the connection"""
 
 		type = args[0].upper()
 		assert type in ("BOOTSTRAP", "SERVER")
+		registering = not self.address
 
 		try:
 			int(args[3])
@@ -909,8 +1759,9 @@ class RemoteConnection ():
 
 			self.address = (args[2], int(args[3]))
 			self.gecos = args[4]
+			self.manager.hostcache.add(self.address)
 			for server in servers:
-				if server == self: continue
+				if server == self or server.internal: continue
 				server.send("SERVER %s %s %d :%s" %
 				 ("*",
 				 self.address[0],
@@ -918,27 +1769,175 @@ class RemoteConnection ():
 				 self.gecos))
 
 		elif type == "SERVER":
+			self.manager.hostcache.add((args[2], int(args[3])))
 			if self.address:
-				self.socket_queue.append(args)
+				self.manager.connect((args[2], int(args[3])), "SERVER")
 			else:
 				self.address = (args[2], int(args[3]))
 				self.gecos = args[4]
 
+		if "BURST" in self.capabs:
+			if registering:
+				self.send_burst()
+			return
+
 		for u in users.itervalues():
-			if not u.local:
+			# users on the other workers are ours as far as the peer knows
+			if not u.local and not u.conn.internal:
 				continue
 			self.send(":%s USER * * * :%s" %
 			 (u.full_hostmask(), u.gecos))
 
+	def send_burst (self):
+		"""sends the users of this gateway and the channels they are in,
+		in bulk, between BURST and EOB:
+
+		BU n!u@h :gecos
+		BC channel +modes :[status]nick ...
+		BL channel list-mode :mask ...
+		BT channel :topic"""
+		start = time.time()
+		# users on the other workers are ours as far as the peer knows
+		ours = set(u for u in users.itervalues()
+		 if u.local or u.conn.internal)
+		lines = ["BU %s :%s" % (u.full_hostmask(), u.gecos) for u in ours]
+		count = 0
+		for chan in channels.itervalues():
+			state = self.channel_lines(chan)
+			if state:
+				count += 1
+				lines.extend(state)
+		self.send("BURST %d %d" % (len(ours), count))
+		for line in lines:
+			self.send(line)
+		self.send("EOB")
+		metrics.observe("burst_seconds", "send", time.time() - start)
+
+	def channel_lines (self, chan):
+		"""our side of a channel as BC, BL and BT lines: its members on this
+		gateway (and the other workers), modes, lists and topic; nothing if
+		none of our users are in it"""
+		if chan.name[0] not in "#+":
+			return []
+		members = ["%s%s" % (chan.status_prefixes[m.status], m.user.nick)
+		 for m in chan.members.itervalues()
+		 if m.user.local or m.user.conn.internal]
+		if not members:
+			return []
+		modes = "+%s" % "".join(sorted(chan.modeflags))
+		lines = ["BC %s %s :%s" % (chan.name, modes, names)
+		 for names in wrap(members, self.burst_width)]
+		for type in sorted(chan.blist):
+			for masks in wrap(sorted(chan.blist[type]), self.burst_width):
+				lines.append("BL %s %s :%s" % (chan.name, type, masks))
+		if chan.topic:
+			lines.append("BT %s :%s" % (chan.name, chan.topic))
+		return lines
+
+	def on_burst (self, args):
+		"""BURST command; starts collecting a netburst"""
+		self.burst = []
+		self.burst_started = time.time()
+
+	def queue_burst (self, args):
+		"""BU, BC, BL and BT commands, kept until EOB; outside a burst they
+		are the answer to a WANT, and applied right away"""
+		if self.burst is None:
+			self.burst_handlers[args[0].upper()](self, args)
+			return
+		self.burst.append(args)
+
+	def on_eob (self, args):
+		"""EOB command; applies the netburst in one go, users first so the
+		channel lines can find them"""
+		if self.burst is None:
+			return
+		burst = self.burst
+		self.burst = None
+		start = time.time()
+		burst.sort(key = lambda args: args[0].upper() != "BU")
+		for args in burst:
+			self.burst_handlers[args[0].upper()](self, args)
+		now = time.time()
+		metrics.observe("burst_seconds", "apply", now - start)
+		metrics.observe("burst_seconds", "receive", now - self.burst_started)
+		self.logger.log("INFO",
+		 "burst from %s: %d lines, %d users in %.1f ms (%.1f ms applying)",
+		 link_name(self), len(burst),
+		 sum(1 for args in burst if args[0].upper() == "BU"),
+		 (now - self.burst_started) * 1e3, (now - start) * 1e3)
+
+	def burst_user (self, args):
+		N, _, uh = args[1].partition("!")
+		U, at, H = uh.partition("@")
+		if not at:
+			channels["&errors"].send_message(None, "NOTICE",
+			 "burst user '%s' did not have enough parts" % args[1])
+			return
+		self.on_user(["USER", "*", "*", "*", args[2]], N, U, H)
+
+	def burst_channel (self, args):
+		Target = args[1]
+		target = casemap.fold(Target)
+		if target[0] not in "#+":
+			return
+		# the peer has users in it, so it wants it
+		self.set_wanted(target, True)
+		if not self.accepts(target):
+			return
+		if target not in channels:
+			channels[target] = channel.Channel(Target)
+		chan = channels[target]
+		joins = []
+		for name in args[3].split():
+			status = 0
+			while name and name[0] in chan.status_prefixes[1:]:
+				status = max(status, chan.status_prefixes.index(name[0]))
+				name = name[1:]
+			member = self.users.get_name(name)
+			if member and member not in chan.members:
+				joins.append((member, status))
+		chan.join_burst(joins)
+		for mode in args[2]:
+			if mode in "ntsim" and mode not in chan.modeflags:
+				chan.modeflags.add(mode)
+				chan.send_mode_change(None, "+%s" % mode)
+
+	def accepts (self, target):
+		"""whether the burst of a channel is taken in: from a link that
+		routes by interest only if someone here is in it, since we would
+		not hear about its users leaving otherwise"""
+		if not self.routed:
+			return True
+		return target in channels and channels[target].interested()
+
+	def burst_list (self, args):
+		chan = channels.get_name(args[1])
+		type = args[2]
+		if not chan or type not in chan.blist:
+			return
+		for mask in args[3].split():
+			mask = casemap.fold(mask)
+			if mask not in chan.blist[type]:
+				chan.add_mask(type, mask)
+				chan.send_mode_change(None, "+%s %s" % (type, mask))
+
+	def burst_topic (self, args):
+		chan = channels.get_name(args[1])
+		if not chan or chan.topic or not args[2]:
+			return
+		chan.topic = args[2]
+		chan.send(":-server-!server@server TOPIC %s :%s" % (chan.name,
+		 chan.topic), False)
+
 	# :n!u@h USER * * * :gecos
-	def on_mode (self, args, n, u, h):
+	def on_mode (self, args, source):
 		target = args[1]
 		if target[0] == "&":
 			channels["&errors"].send_message(None, "NOTICE", "Can't change modes of &local channels remotely")
 			self.error("Local channels are not shared")
 			return
-		Target = target
-		target = Target.lower()
+		target = casemap.fold(target)
 		if target not in channels:
 			return
 		modes = args[2]
@@ -950,7 +1949,7 @@ class RemoteConnection ():
 			if targetuser == None: return
 			if op == "+" and targetuser.status >= channels[target].mode_to_status(mode): return
 			if op == "-" and targetuser.status == 0: return
-			channels[target].send_mode_change(users[n.lower()], "%s%s %s" % (op, mode, param))
+			channels[target].send_mode_change(source, "%s%s %s" % (op, mode, param))
 			if op == "+":
 				channels[target].set_status(targetuser, channels[target].mode_to_status(mode))
 			else:
@@ -961,26 +1960,26 @@ class RemoteConnection ():
 			if op == "+": channels[target].modeflags.add(mode)
 			if op == "-" and not (mode in channels[target].modeflags): return
 			if op == "-": channels[target].modeflags.remove(mode)
-			channels[target].send_mode_change(users[n.lower()], "%s%s" % (op, mode))
+			channels[target].send_mode_change(source, "%s%s" % (op, mode))
 			return
 		if mode in "beI":
-			targetmask = param
+			targetmask = casemap.fold(param)
 			SET = "+"
 			UNSET = "-"
 			action = op
-			print mode, target, targetmask
-			if (action == SET and not targetmask.lower() in channels[target].blist[mode]) or (action == UNSET and targetmask.lower() in channels[target].blist[mode]):
+			self.logger.log("DEBUG", "remote mode %s on %s: %s", mode, target,
+			 targetmask)
+			if (action == SET and not targetmask in channels[target].blist[mode]) or (action == UNSET and targetmask in channels[target].blist[mode]):
 				if action == SET:
-					channels[target].blist[mode].add(targetmask.lower())
+					channels[target].add_mask(mode, targetmask)
 				else:
-					channels[target].blist[mode].remove(targetmask.lower())
-				channels[target].send_mode_change(users[n.lower()],"+%s %s" % (mode, targetmask.lower()))
+					channels[target].remove_mask(mode, targetmask)
+				channels[target].send_mode_change(source,"+%s %s" % (mode, targetmask))
 				
 
 
 	def on_user (self, args, N, U, H):
 		"""USER command that introduces users from the connection"""
-		n = N.lower()
 		for letter in N+U:
 			if letter not in nick_chars:
 				channels["&errors"].send_message(None, "NOTICE",
@@ -989,21 +1988,21 @@ class RemoteConnection ():
 				self.send_numeric(461, N)
 				self.error("Cannot introduce user")
 
-		self.users[n] = users[n] = user.User(
-		 socket = self.sock,
-		 address = (H, 0),
+		u = user.User(
+		 conn = self,
+		 host = H,
 		 local = False,
 		 nick = N,
 		 ident = U,
-		 logger = self.logger,
 		 gecos = args[4])
+		self.users[u.key] = users[u.key] = u
 
-	def on_nick (self, args, n, u, h):
+	def on_nick (self, args, source):
 		"""NICK command"""
 		if not args[1]:
 			channels["&errors"].send_message(None, "NOTICE",
 			 "%s tried to change nick to '%s' (not enough args)" %
-			 (n, args[1]))
+			 (source.nick, args[1]))
 			self.send_numeric(432, args[1])
 			self.error("Erroneous nickname")
 			return
@@ -1012,32 +2011,37 @@ class RemoteConnection ():
 			if letter not in nick_chars:
 				channels["&errors"].send_message(None, "NOTICE",
 				 "%s tried to change nick to '%s' (illegal characters)" %
-				 (n, args[1]))
+				 (source.nick, args[1]))
 				self.send_numeric(432, args[1])
 				self.error("Erroneous nickname")
 				return
 
-		if args[1] == n:
+		if args[1] == source.nick:
 			return
 
-		if args[1].lower() in users and args[1].lower() != n.lower():
+		key = casemap.fold(args[1])
+		if key in users and key != source.key:
 			channels["&errors"].send_message(None, "NOTICE",
 			 "%s tried to change nick to '%s' (nick in use)" %
-			 (n, args[1]))
+			 (source.nick, args[1]))
 			self.send_numeric(433, args[1])
 			self.error("Nickname already in use")
 			return
 
-		self.broadcast_local(users[n.lower()], "NICK %s" % args[1])
+		self.broadcast_local(source, "NICK %s" % args[1])
 
-		users[n.lower()].nick = args[1]
-		del self.users[n.lower()]
-		self.users[args[1].lower()] = users[args[1].lower()] = users.pop(n.lower())
+		oldkey = source.key
+		source.set_nick(args[1])
+		del users[oldkey]
+		del self.users[oldkey]
+		self.users[key] = users[key] = source
+		for c in source.channels:
+			channels[c].rename_user(source, oldkey)
 
-	def on_message (self, args, n, u, h):
+	def on_message (self, args, source):
 		"""PRIVMSG/NOTICE commands"""
 		type = args[0].upper()
-		target = args[1].lower()
+		target = casemap.fold(args[1])
 		message = args[2]
 		assert type in ["PRIVMSG", "NOTICE"]
 
@@ -1046,27 +2050,27 @@ class RemoteConnection ():
 			return
 
 		if target in channels:
-			if channels[target].get_channeluser(users[n.lower()]) not in channels[target].members:
+			if source not in channels[target].members:
 				if type == "PRIVMSG":
 					#self.send_numeric(404, "%s :Cannot send to channel" %
 					# target)
 					return
-			channels[target].send_message(users[n.lower()], type, message)
+			channels[target].send_message(source, type, message)
 
 
 			return
 
 		if target in users and users[target].local:
-			users[target].send(":%s %s %s :%s" % (self.user.full_hostmask(),
-			 type, target, message))
+			users[target].send(":%s %s %s :%s" %
+			 (source.full_hostmask(), type, users[target].nick, message))
 			return
 
 		if type == "PRIVMSG":
-			self.send_numeric(401, "%s :No such target" % target)
+			self.send_numeric(401, "%s :No such target" % args[1])
 
-	def on_topic (self, args, n, u, h):
+	def on_topic (self, args, source):
 		"""TOPIC command"""
-		target = args[1].lower()
+		target = casemap.fold(args[1])
 
 		if target not in channels:
 			#self.send_numeric(403, "%s :No such channel" % target)
@@ -1074,15 +2078,15 @@ class RemoteConnection ():
 
 		if len(args) > 2:
 			message = args[2]
-			channels[target].change_topic(users[n.lower()], message)
+			channels[target].change_topic(source, message)
 			return
 
 		#self.send_numeric(332, "%s :%s" % (target, channels[target].topic))
 
-	def on_invite (self, args, n, u, h):
+	def on_invite (self, args, source):
 		"""INVITE command"""
-		target = args[1].lower()
-		channel = args[2].lower()
+		target = casemap.fold(args[1])
+		channel = casemap.fold(args[2])
 
 		if target not in users:
 			#self.send_numeric(401, "%s :No such target" % target)
@@ -1092,13 +2096,13 @@ class RemoteConnection ():
 			#self.send_numeric(403, "%s :No such channel" % channel)
 			return
 
-		users[target].send(":%s!%s@%s INVITE %s :%s" % (n, u, h,
-		 target, channel))
+		users[target].send(":%s INVITE %s :%s" % (source.full_hostmask(),
+		 users[target].nick, channels[channel].name))
 
-	def on_join (self, args, n, u, h):
+	def on_join (self, args, source):
 		"""JOIN command"""
 		Target = args[1]
-		target = Target.lower()
+		target = casemap.fold(Target)
 
 		if target[0] not in "#+":
 			return
@@ -1106,121 +2110,158 @@ class RemoteConnection ():
 		if target not in channels:
 			channels[target] = channel.Channel(Target)
 
-		if channels[target].get_channeluser(users[n.lower()]) not in channels[target].members:
-			channels[target].join_user(users[n.lower()])
+		if source not in channels[target].members:
+			channels[target].join_user(source)
 
-	def on_part (self, args, n, u, h):
+	def on_part (self, args, source):
 		"""PART command"""
-		target = args[1].lower()
+		target = casemap.fold(args[1])
 		if not target in channels:
 			return
 
-		channels[target].part_user(users[n.lower()])
-	def on_kick (self, args, n, u, h):
-		target = args[1].lower()
+		channels[target].part_user(source)
+		if not channels[target].members and not channels[target].immutable:
+			del channels[target]
+
+	def on_away (self, args, source):
+		"""AWAY command"""
+		source.away = args[1] if len(args) > 1 else None
+	def on_kick (self, args, source):
+		target = casemap.fold(args[1])
 		if not target in channels:
 			return
-		channels[target].kick_user(users[n.lower()], users[args[2].lower()], "Kicked")
-	def on_quit (self, args, n, u, h):
+		channels[target].kick_user(source, users.get_name(args[2]), "Kicked")
+	def on_quit (self, args, source):
 		"""QUIT command"""
 		reason = args[1] if len(args) > 1 else "Exited"
-		self.broadcast_local(users[n.lower()], "QUIT %s" % reason)
-
-		del users[n.lower()]
-		del self.users[n.lower()]
-
-	def prc_callback (self, command, line, min_args, cb, prefix = True,
-	 pre_register = False):
-		if prefix and len(line) < 2:
-			return False
-
-		if command != line[prefix].upper():
-			return False
+		self.broadcast_local(source, "QUIT :%s" % reason)
+
+		forget_user(source)
+		del self.users[source.key]
+
+	# link-level commands that worker 0 does not pass on
+	unrelayed = ("BOOTSTRAP", "SERVER", "PING", "PONG", "ERROR", "CAPAB",
+	 "ZIP", "WANT", "UNWANT")
+
+	# burst lines about one channel, passed on to the workers only if
+	# accepts() takes the channel in
+	channel_burst = ("BC", "BL", "BT")
+
+	# command: (min_args, handler, prefix, pre_register)
+	commands = {
+		"BOOTSTRAP": (4, on_server, False, True),
+		"SERVER": (4, on_server, False, True),
+		"USER": (4, on_user, True, False),
+		"NICK": (1, on_nick, True, False),
+		"PRIVMSG": (2, on_message, True, False),
+		"NOTICE": (2, on_message, True, False),
+		"TOPIC": (2, on_topic, True, False),
+		"INVITE": (2, on_invite, True, False),
+		"JOIN": (1, on_join, True, False),
+		"PART": (1, on_part, True, False),
+		"QUIT": (0, on_quit, True, False),
+		"KICK": (2, on_kick, True, False),
+		"MODE": (2, on_mode, True, False),
+		"AWAY": (0, on_away, True, False),
+		"PING": (1, on_ping, False, True),
+		"PONG": (0, on_pong, False, True),
+		"CAPAB": (1, on_capab, False, True),
+		"ZIP": (0, on_zip, False, True),
+		"BURST": (0, on_burst, False, False),
+		"BU": (2, queue_burst, False, False),
+		"BC": (3, queue_burst, False, False),
+		"BL": (3, queue_burst, False, False),
+		"BT": (2, queue_burst, False, False),
+		"EOB": (0, on_eob, False, False),
+		"WANT": (1, on_want, False, False),
+		"UNWANT": (1, on_unwant, False, False),
+	}
+
+	burst_handlers = {
+		"BU": burst_user,
+		"BC": burst_channel,
+		"BL": burst_list,
+		"BT": burst_topic,
+	}
+
+	def prc_callback (self, msg):
+		entry = self.commands.get(msg.command)
+		if not entry or entry[2] != (msg.prefix is not None):
+			metrics.count("link_lines_in", "unknown")
+			channels["&errors"].send_message(None, "NOTICE",
+			 "server command not recognised")
+			return
+		metrics.count("link_lines_in", msg.command)
+		min_args, cb, prefix, pre_register = entry
 
 		if not pre_register and not self.address:
 			channels["&errors"].send_message(None, "NOTICE",
-			 "server attempted command '%s' before registering" % line[prefix])
+			 "server attempted command '%s' before registering" % msg.args[0])
 			self.send_numeric(451, ":Connection not registered")
-			return True
+			return
 
-		if len(line) < min_args + prefix + 1:
+		if len(msg.args) < min_args + 1:
 			channels["&errors"].send_message(None, "NOTICE",
 			 "server did not give enough params for command '%s'" %
-			  line[prefix])
-			return True
-
-		args = line
-		argrange = xrange(1, len(line)) if prefix else xrange(len(line))
-
-		for i in argrange:
-			if line[i].startswith(":"):
-				args = line[:i] + [" ".join(line[i:])[1:]]
-				break
+			  msg.args[0])
+			return
 
 		if prefix:
-			if "!" not in args[0]:
+			n, _, uh = msg.prefix.partition("!")
+			u, at, h = uh.partition("@")
+			if not at:
 				channels["&errors"].send_message(None, "NOTICE",
 				 "prefix did not have enough parts")
-				return True
-			n, uh = args[0].lstrip(":").split("!", 1)
-
-			if "@" not in uh:
-				channels["&errors"].send_message(None, "NOTICE",
-				 "prefix did not have enough parts")
-				return True
-			u, h = uh.split("@", 1)
-
-			if command != "USER" and n.lower() not in users:
-				channels["&errors"].send_message(None, "NOTICE",
-				 "invalid prefix '%s'" % n)
-				return True
+				return
 
-			cb(args[1:], n, u, h)
-			return True
+			if msg.command == "USER":
+				start = time.time()
+				cb(self, msg.args, n, u, h)
+			else:
+				# the one fold of the source's nick; handlers get the User
+				source = users.get_name(n)
+				if not source:
+					channels["&errors"].send_message(None, "NOTICE",
+					 "invalid prefix '%s'" % n)
+					return
+				start = time.time()
+				cb(self, msg.args, source)
+			metrics.observe("link_handler_seconds", msg.command,
+			 time.time() - start)
+			return
 
-		cb(args)
-		return True
+		start = time.time()
+		cb(self, msg.args)
+		metrics.observe("link_handler_seconds", msg.command,
+		 time.time() - start)
 
 	def handle_line (self, line):
-		channels["&rawlog"].send_message(None, "PRIVMSG", "%s %s" %
-		 (self.address, line))
-		line = line.split(" ")
-
-		for i in (
-			#(command, min_args, cb, prefix, pre_register)
-			("BOOTSTRAP", 4, self.on_server, False, True),
-			("SERVER", 4, self.on_server, False, True),
-			("USER", 4, self.on_user, True, False),
-			("NICK", 1, self.on_nick, True, False),
-			("PRIVMSG", 2, self.on_message, True, False),
-			("NOTICE", 2, self.on_message, True, False),
-			("TOPIC", 2, self.on_topic, True, False),
-			("INVITE", 2, self.on_invite, True, False),
-			("JOIN", 1, self.on_join, True, False),
-			("PART", 1, self.on_part, True, False),
-			("QUIT", 0, self.on_quit, True, False),
-			("KICK", 2, self.on_kick, True, False),
-			("MODE", 2, self.on_mode, True, False),
-		):
-			if self.prc_callback(i[0], line, i[1], i[2], i[3], i[4]):
-				break
-		else:
-			channels["&errors"].send_message(None, "NOTICE",
-			 "server command not recognised")
+		msg = message.parse(line)
+		rawlog.tap(msg.prefix, self.address or ("*", 0), msg.command, line)
+		if msg.id:
+			# the same event over another path, or our own coming back
+			if msg.id in message.seen:
+				metrics.count("link_duplicates", msg.command)
+				return
+			message.seen.add(msg.id)
+		self.prc_callback(msg)
+		if (self.manager.workers and msg.command not in self.unrelayed and
+		 not msg.command.isdigit() and (msg.command not in
+		 self.channel_burst or (len(msg.args) > 1 and
+		 self.accepts(casemap.fold(msg.args[1]))))):
+			self.manager.relay(self, line, msg)
 
 	def loop (self):
-		self.data_in += self.sock.recv(512)
 		# takes \r\n or \n. preferred line ending is \n
-		lines = self.data_in.replace("\r\n", "\n").split("\n")
-		self.data_in = lines.pop()
-
-		for line in lines:
-			self.logger.log_line("DEBUG",
-			 "\x1b[32;2m<<\x1b[0;1m from %s\x1b[0m %s" %
-			 (self.address[0] if self.address else "*", line))
+		for line in self.linebuf.read(self.sock):
+			if self.closed:
+				break
+			if self.logger.debug:
+				self.logger.log("DEBUG",
+				 "\x1b[32;2m<<\x1b[0;1m from %s\x1b[0m %s",
+				 self.address[0] if self.address else "*", line)
+			self.lines_in += 1
 			self.handle_line(line)
-
-	def __del__ (self):
-		self.logger.log_line("DEBUG", "remote %s deleted" %
-		 (self.address[0] if self.address else "*"))
+		self.lastseen = time.time()
+		self.pinged = False
 
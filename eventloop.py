@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import select
+import socket
+import time
+import timers
+from errno import EINTR
+
+class EventLoop ():
+	"""readiness-based dispatcher for listeners and connections
+
+	each registered socket has a reader callback, called when the socket is
+	readable (or has hung up), and an optional writer callback, called when
+	the socket is writable and write interest has been turned on"""
+	def __init__ (self, logger):
+		self.logger = logger
+		self.handlers = {}
+		# when the last wait ended, for timing the work that followed it
+		self.woke = time.time()
+		self.timers = timers.TimerWheel()
+		if hasattr(select, "epoll"):
+			self.backend = "epoll"
+			self.poller = select.epoll()
+			self.READ = select.EPOLLIN | select.EPOLLPRI
+			self.WRITE = select.EPOLLOUT
+			self.ERROR = select.EPOLLERR | select.EPOLLHUP
+		elif hasattr(select, "poll"):
+			self.backend = "poll"
+			self.poller = select.poll()
+			self.READ = select.POLLIN | select.POLLPRI
+			self.WRITE = select.POLLOUT
+			self.ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+		else:
+			self.backend = "select"
+			self.poller = None
+			self.READ, self.WRITE, self.ERROR = 1, 4, 8
+		self.logger.log("DEBUG", "event loop using %s", self.backend)
+
+	def call_later (self, delay, callback, *args):
+		"""runs callback(*args) from the loop after delay seconds; returns a
+		timer that can be cancelled"""
+		return self.timers.call_later(delay, callback, *args)
+
+	def register (self, sock, reader, writer = None):
+		"""starts watching sock for readability"""
+		fd = sock.fileno()
+		self.handlers[fd] = [sock, reader, writer, self.READ]
+		if self.poller:
+			self.poller.register(fd, self.READ)
+
+	def unregister (self, sock):
+		"""stops watching sock; must be called before the socket is closed"""
+		try:
+			fd = sock.fileno()
+		except socket.error:
+			return
+		if fd not in self.handlers or self.handlers[fd][0] is not sock:
+			return
+		del self.handlers[fd]
+		if self.poller:
+			try:
+				self.poller.unregister(fd)
+			except (IOError, KeyError, ValueError):
+				pass
+
+	def set_writable (self, sock, enabled):
+		"""turns write interest for sock on or off"""
+		handler = self.handlers.get(sock.fileno())
+		if not handler:
+			return
+		mask = self.READ | self.WRITE if enabled else self.READ
+		if handler[3] == mask:
+			return
+		handler[3] = mask
+		if self.poller:
+			self.poller.modify(sock.fileno(), mask)
+
+	def poll (self, timeout):
+		"""returns a list of (fd, event mask) pairs"""
+		if self.backend == "epoll":
+			return self.poller.poll(-1 if timeout is None else timeout)
+		if self.backend == "poll":
+			return self.poller.poll(None if timeout is None else timeout * 1000)
+
+		readers = self.handlers.keys()
+		writers = [fd for fd, h in self.handlers.iteritems()
+		 if h[3] & self.WRITE]
+		r, w, x = select.select(readers, writers, readers, timeout)
+		events = {}
+		for fd in r:
+			events[fd] = events.get(fd, 0) | self.READ
+		for fd in w:
+			events[fd] = events.get(fd, 0) | self.WRITE
+		for fd in x:
+			events[fd] = events.get(fd, 0) | self.ERROR
+		return events.items()
+
+	def run_once (self, timeout = None):
+		"""waits up to timeout seconds (or until the next timer is due),
+		dispatches every ready socket and then runs the due timers"""
+		wait = self.timers.timeout(time.time())
+		if wait is not None and (timeout is None or wait < timeout):
+			timeout = wait
+		if timeout is not None:
+			timeout = timers.round_up(timeout)
+		try:
+			events = self.poll(timeout)
+		except (IOError, OSError, select.error) as e:
+			if e.args[0] == EINTR:
+				return
+			raise
+		self.woke = time.time()
+
+		for fd, mask in events:
+			handler = self.handlers.get(fd)
+			if not handler:
+				# unregistered by an earlier callback in this batch
+				continue
+			if mask & (self.READ | self.ERROR):
+				handler[1]()
+			if (mask & self.WRITE and handler[2] and
+			 self.handlers.get(fd) is handler):
+				handler[2]()
+
+		self.timers.run(time.time())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import os
+import time
+
+class Host ():
+	"""what we know about one server address"""
+	def __init__ (self, address, successes = 0, failures = 0, latency = 0.0,
+	 seen = 0):
+		self.address = address
+		self.successes = successes
+		self.failures = failures
+		# moving average of the connect time in seconds; 0 if never measured
+		self.latency = latency
+		self.seen = seen
+
+	def score (self):
+		"""higher is better: the (smoothed) success rate per second of
+		connect latency, with unmeasured hosts assumed to take 5 seconds"""
+		rate = (self.successes + 1.0) / (self.successes + self.failures + 2.0)
+		return rate / (self.latency or 5.0)
+
+class HostCache ():
+	"""the servers of a network we have heard of, kept in
+	hostcache/<network>
+
+	each line is "host port successes failures latency last-seen"; files
+	with just "host port" lines (as written by hand) load fine"""
+	# weight of a new latency sample in the moving average
+	alpha = 0.3
+
+	def __init__ (self, path, logger):
+		self.path = path
+		self.logger = logger
+		self.hosts = {}
+		self.dirty = False
+		self.load()
+
+	def load (self):
+		try:
+			with open(self.path) as f:
+				lines = f.read().split("\n")
+		except IOError:
+			return
+		for line in lines:
+			fields = line.split()
+			if len(fields) < 2:
+				continue
+			try:
+				address = (fields[0], int(fields[1]))
+				stats = [int(fields[2]), int(fields[3]), float(fields[4]),
+				 int(fields[5])] if len(fields) >= 6 else []
+			except ValueError:
+				continue
+			self.hosts[address] = Host(address, *stats)
+
+	def save (self):
+		"""rewrites the file if anything changed, replacing it atomically so
+		a crash never leaves a truncated hostcache behind"""
+		if not self.dirty:
+			return
+		directory = os.path.dirname(self.path)
+		temp = "%s.%d.tmp" % (self.path, os.getpid())
+		try:
+			if directory and not os.path.isdir(directory):
+				os.makedirs(directory)
+			with open(temp, "w") as f:
+				for host in self.ranked():
+					f.write("%s %d %d %d %.4f %d\n" % (host.address[0],
+					 host.address[1], host.successes, host.failures,
+					 host.latency, host.seen))
+				f.flush()
+				os.fsync(f.fileno())
+			os.rename(temp, self.path)
+			self.dirty = False
+		except (IOError, OSError) as e:
+			self.logger.log("WARN", "could not write %s: %s", self.path, e)
+
+	def __len__ (self):
+		return len(self.hosts)
+
+	def add (self, address):
+		"""records an announced server"""
+		host = self.hosts.get(address)
+		if not host:
+			host = self.hosts[address] = Host(address)
+		host.seen = int(time.time())
+		self.dirty = True
+
+	def success (self, address, latency):
+		self.add(address)
+		host = self.hosts[address]
+		host.successes += 1
+		if host.latency:
+			host.latency += self.alpha * (latency - host.latency)
+		else:
+			host.latency = latency
+
+	def failure (self, address):
+		self.add(address)
+		self.hosts[address].failures += 1
+
+	def ranked (self):
+		"""every host, best first"""
+		return sorted(self.hosts.itervalues(), key = Host.score,
+		 reverse = True)
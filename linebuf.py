@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+import socket
+import zlib
+
+class LineTooLong (socket.error):
+	"""raised by LineBuffer for a line over max_line, so the connection
+	can be told why it is being closed"""
+	pass
+
+class LineBuffer ():
+	"""incremental line framing for one connection
+
+	data is read in large chunks into a reusable receive buffer and
+	appended to a bytearray; terminators are only searched for in bytes
+	that have not been scanned yet, and consumed lines are cut off the
+	front in one go. any of \\r\\n, \\n\\r, \\r and \\n end a line, so all
+	the odd client line endings work, and empty lines are skipped.
+
+	max_line is a hard limit on the length of a line, terminated or not,
+	which also bounds how much unterminated data a peer can make us hold;
+	going over it raises LineTooLong, a socket.error like any other broken
+	connection
+
+	if marker is set, everything after a line equal to it is taken to be a
+	zlib stream, which is inflated before it is framed from then on; the
+	marker line itself is still returned"""
+	def __init__ (self, max_line, chunk = 16384):
+		self.max_line = max_line
+		self.data = bytearray()
+		self.scanned = 0
+		# bytes read so far
+		self.received = 0
+		self.chunk = bytearray(chunk)
+		self.view = memoryview(self.chunk)
+		self.marker = None
+		self.inflater = None
+
+	def read (self, sock):
+		"""reads what the socket has and returns the complete lines"""
+		count = sock.recv_into(self.chunk)
+		if not count:
+			raise socket.error, "Connection closed"
+		self.received += count
+		if self.inflater:
+			try:
+				self.data += self.inflater.decompress(self.view[:count].tobytes())
+			except zlib.error as e:
+				raise socket.error, "Bad compressed data (%s)" % e
+		else:
+			self.data += self.view[:count]
+		return self.lines()
+
+	def inflate (self, start):
+		"""switches to reading a zlib stream from data[start:] on"""
+		self.marker = None
+		self.inflater = zlib.decompressobj()
+		rest = str(self.data[start:])
+		del self.data[:]
+		try:
+			self.data += self.inflater.decompress(rest)
+		except zlib.error as e:
+			raise socket.error, "Bad compressed data (%s)" % e
+
+	def lines (self):
+		data = self.data
+		lines = []
+		start = 0
+		lf = data.find("\n", self.scanned)
+		cr = data.find("\r", self.scanned)
+
+		while lf >= 0 or cr >= 0:
+			if cr < 0 or 0 <= lf < cr:
+				end = lf
+				lf = data.find("\n", end + 1)
+			else:
+				end = cr
+				cr = data.find("\r", end + 1)
+			if end - start > self.max_line:
+				raise LineTooLong, "Line too long"
+			if end > start:
+				lines.append(str(data[start:end]))
+				if lines[-1] == self.marker:
+					self.inflate(end + 1)
+					start = 0
+					lf = data.find("\n")
+					cr = data.find("\r")
+					continue
+			start = end + 1
+
+		if start:
+			del data[:start]
+		if len(data) > self.max_line:
+			raise LineTooLong, "Line too long"
+		self.scanned = len(data)
+		return lines
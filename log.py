@@ -1,5 +1,87 @@
 #!/usr/bin/env python
 
+import atexit
+import os
+import Queue
+import sys
+import threading
+
+class writer (threading.Thread):
+	"""background thread that owns the log sink
+
+	lines are handed over through a bounded queue; if the sink falls behind
+	and the queue fills up, lines are dropped and counted rather than
+	blocking the caller"""
+	def __init__ (self, filename = None, rotate_size = 0, rotate_count = 0,
+	 queue_size = 8192):
+		threading.Thread.__init__(self, name = "log writer")
+		self.daemon = True
+		self.filename = filename
+		self.rotate_size = rotate_size
+		self.rotate_count = rotate_count
+		self.queue = Queue.Queue(queue_size)
+		self.dropped = 0
+		self.size = 0
+		self.out = None
+		self.open()
+
+	def open (self):
+		if not self.filename:
+			self.out = sys.stdout
+			return
+		self.out = open(self.filename, "a")
+		self.size = self.out.tell()
+
+	def rotate (self):
+		self.out.close()
+		for i in xrange(self.rotate_count - 1, 0, -1):
+			if os.path.exists("%s.%d" % (self.filename, i)):
+				os.rename("%s.%d" % (self.filename, i),
+				 "%s.%d" % (self.filename, i + 1))
+		if self.rotate_count:
+			os.rename(self.filename, "%s.1" % self.filename)
+		else:
+			os.remove(self.filename)
+		self.open()
+
+	def put (self, line):
+		try:
+			self.queue.put_nowait(line)
+		except Queue.Full:
+			self.dropped += 1
+
+	def run (self):
+		while True:
+			lines = [self.queue.get()]
+			# write whatever else piled up in one go
+			try:
+				while len(lines) < 1024:
+					lines.append(self.queue.get_nowait())
+			except Queue.Empty:
+				pass
+			done = None in lines
+			if done:
+				lines = lines[:lines.index(None)]
+			if self.dropped:
+				dropped, self.dropped = self.dropped, 0
+				lines.append("log: %d lines dropped" % dropped)
+			data = "".join("%s\n" % line for line in lines)
+			try:
+				self.out.write(data)
+				self.out.flush()
+			except (IOError, OSError):
+				pass
+			self.size += len(data)
+			if (self.filename and self.rotate_size and
+			 self.size >= self.rotate_size):
+				self.rotate()
+			if done:
+				return
+
+	def close (self):
+		self.queue.put(None)
+		self.join(5)
+
 class logger ():
 	levels = {
 	 "DEBUG"  : 1,
@@ -11,18 +93,39 @@ class logger ():
 	}
 
 	def __init__ (self, loglevel):
+		self.writer = None
 		self.set_level(loglevel)
 
 	def set_level (self, loglevel):
 		assert loglevel in self.levels
 
 		self.loglevel = self.levels[loglevel]
+		# checked directly on the hottest paths
+		self.debug = self.enabled("DEBUG")
+
+	def enabled (self, level):
+		return self.loglevel <= self.levels[level]
+
+	def start (self, filename = None, rotate_size = 0, rotate_count = 0):
+		"""moves output to a background writer, optionally into a file"""
+		self.writer = writer(filename, rotate_size, rotate_count)
+		self.writer.start()
+		atexit.register(self.stop)
+
+	def stop (self):
+		if self.writer:
+			self.writer.close()
+			self.writer = None
 
-	def log_line (self, level, message):
+	def log (self, level, format, *args):
+		"""logs format % args, rendering it only if level is enabled"""
 		assert level in self.levels
 
-		if self.loglevel <= self.levels[level]:
-			print message
-			return 0
-		else:
+		if self.loglevel > self.levels[level]:
 			return 1
+		message = format % args if args else format
+		if self.writer:
+			self.writer.put(message)
+		else:
+			print message
+		return 0
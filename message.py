@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import os
+
+class Message (object):
+	"""a parsed IRC/PRC line
+
+	prefix is the source without its leading ':' (None if the line had
+	none), command is the uppercased command, and args is the command as
+	sent followed by its parameters, the trailing parameter last; this is
+	the list the on_* handlers take; id is the event id of a tagged
+	server line, or None"""
+	__slots__ = ("prefix", "command", "args", "id")
+
+	def __init__ (self, prefix, command, args, id = None):
+		self.prefix = prefix
+		self.command = command
+		self.args = args
+		self.id = id
+
+class Ids (object):
+	"""hands out the ids of the events this process starts: a random
+	origin and a sequence number"""
+	__slots__ = ("origin", "sequence")
+
+	def __init__ (self):
+		self.origin = os.urandom(4).encode("hex")
+		self.sequence = 0
+
+	def next (self):
+		self.sequence += 1
+		return "%s.%x" % (self.origin, self.sequence)
+
+class SeenCache (object):
+	"""the ids of recently seen events
+
+	ids go into the current generation; once it holds size of them it
+	becomes the previous one and the one before is forgotten, so adding
+	and looking up stay O(1) and at most 2 * size ids are kept"""
+	__slots__ = ("size", "current", "previous")
+
+	def __init__ (self, size = 65536):
+		self.size = size
+		self.current = set()
+		self.previous = set()
+
+	def __contains__ (self, id):
+		return id in self.current or id in self.previous
+
+	def add (self, id):
+		self.current.add(id)
+		if len(self.current) >= self.size:
+			self.previous = self.current
+			self.current = set()
+
+# forked workers get their own, see prc.spawn_workers()
+ids = Ids()
+seen = SeenCache()
+
+def tag (line):
+	"""prefixes a server line with a new event id, which counts as seen
+	here so the event is not taken back if it comes around again"""
+	id = ids.next()
+	seen.add(id)
+	return "@id=%s %s" % (id, line)
+
+def untag (line):
+	"""the line without its tags, for peers that do not take them"""
+	if line[:1] == "@":
+		return line.split(" ", 1)[1] if " " in line else ""
+	return line
+
+def parse (line):
+	"""splits a line into prefix, command and parameters in one pass"""
+	id = None
+	if line[:1] == "@":
+		tags, _, line = line[1:].partition(" ")
+		for tag in tags.split(";"):
+			if tag[:3] == "id=":
+				id = tag[3:]
+
+	prefix = None
+	if line[:1] == ":":
+		space = line.find(" ")
+		if space < 0:
+			return Message(line[1:], "", [], id)
+		prefix = line[1:space]
+		line = line[space + 1:]
+
+	if line[:1] == ":":
+		args = [line[1:]]
+	else:
+		trailing = line.find(" :")
+		if trailing < 0:
+			args = line.split()
+		else:
+			args = line[:trailing].split()
+			args.append(line[trailing + 2:])
+
+	return Message(prefix, args[0].upper() if args else "", args, id)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""counters and histograms collected while the gateway runs
+
+updating a counter is a dict lookup and an add, and timing a handler is
+two time.time() calls and a bisect, so collection is always on. values
+are read through the oper STATS command and, if METRICS_BIND is set, a
+small HTTP endpoint in Prometheus text exposition format"""
+
+import socket
+from bisect import bisect_left
+from errno import EAGAIN, EWOULDBLOCK
+
+# (name, label value) -> count
+counters = {}
+# (name, label value) -> Histogram
+histograms = {}
+# name -> (type, help, label name)
+families = {}
+# callables returning (name, label value, value) samples that are only
+# worked out when someone looks: gauges, and totals over live connections
+collectors = []
+
+class Histogram (object):
+	"""counts of observations falling into fixed buckets"""
+	__slots__ = ("counts", "sum", "count")
+	# upper bounds in seconds, roughly three per decade
+	buckets = (0.00001, 0.00003, 0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03,
+	 0.1, 0.3, 1.0, 3.0)
+
+	def __init__ (self):
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe (self, value):
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def quantile (self, fraction):
+		"""upper bound of the bucket the given quantile falls into"""
+		rank = fraction * self.count
+		seen = 0
+		for i, n in enumerate(self.counts):
+			seen += n
+			if seen >= rank and n:
+				return self.buckets[i] if i < len(self.buckets) else None
+		return None
+
+def describe (name, type, help, label = None):
+	families[name] = (type, help, label)
+
+def count (name, label = None, n = 1):
+	key = (name, label)
+	counters[key] = counters.get(key, 0) + n
+
+def observe (name, label, value):
+	key = (name, label)
+	histogram = histograms.get(key)
+	if histogram is None:
+		histogram = histograms[key] = Histogram()
+	histogram.observe(value)
+
+def command_of (line):
+	"""the command of an outgoing line, skipping any tags and prefix"""
+	if line[:1] == "@":
+		line = line.split(" ", 1)[1] if " " in line else ""
+	if line[:1] == ":":
+		return line.split(" ", 2)[1] if " " in line else ""
+	return line.split(" ", 1)[0]
+
+def count_line (name, line, n = 1):
+	count(name, command_of(line), n)
+
+def collect ():
+	"""every counter and gauge value, with the collectors' samples added"""
+	values = dict(counters)
+	for collector in collectors:
+		for name, label, value in collector():
+			values[(name, label)] = values.get((name, label), 0) + value
+	return values
+
+def exposition ():
+	"""everything in Prometheus text exposition format"""
+	values = collect()
+	out = []
+	for name in sorted(families):
+		type, help, label = families[name]
+		metric = "prc_%s" % name
+		out.append("# HELP %s %s" % (metric, help))
+		out.append("# TYPE %s %s" % (metric, type))
+		if type == "histogram":
+			for (n, value), histogram in sorted(histograms.iteritems()):
+				if n != name:
+					continue
+				labels = '%s="%s",' % (label, value) if label else ""
+				seen = 0
+				for bound, count in zip(Histogram.buckets + ("+Inf",),
+				 histogram.counts):
+					seen += count
+					out.append('%s_bucket{%sle="%s"} %d' % (metric, labels,
+					 bound, seen))
+				labels = "{%s}" % labels[:-1] if labels else ""
+				out.append("%s_sum%s %f" % (metric, labels, histogram.sum))
+				out.append("%s_count%s %d" % (metric, labels, histogram.count))
+			continue
+		if type == "counter":
+			metric += "_total"
+		for (n, value), number in sorted(values.iteritems()):
+			if n != name:
+				continue
+			if label:
+				out.append('%s{%s="%s"} %s' % (metric, label, value, number))
+			else:
+				out.append("%s %s" % (metric, number))
+	return "\n".join(out) + "\n"
+
+class Endpoint ():
+	"""answers every HTTP request on a local port with exposition()
+
+	scrapes are rare and the reply is small, so it is written in one go
+	with a short timeout rather than queued"""
+	def __init__ (self, bind_address, events, logger):
+		self.events = events
+		self.logger = logger
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		try:
+			self.sock.bind(bind_address)
+		except socket.error as e:
+			exit("error in METRICS_BIND address %s:%d (%s)" % (bind_address[0],
+			 bind_address[1], e))
+		self.sock.setblocking(0)
+		self.sock.listen(16)
+		self.events.register(self.sock, self.accept)
+
+	def accept (self):
+		while True:
+			try:
+				sock, address = self.sock.accept()
+			except socket.error as e:
+				if e.errno not in (EAGAIN, EWOULDBLOCK):
+					self.logger.log("WARN", "metrics accept failed: %s", e)
+				return
+			self.events.register(sock, lambda sock = sock: self.answer(sock))
+
+	def answer (self, sock):
+		self.events.unregister(sock)
+		try:
+			sock.recv(4096)
+			body = exposition()
+			sock.settimeout(1)
+			sock.sendall("HTTP/1.0 200 OK\r\n"
+			 "Content-Type: text/plain; version=0.0.4\r\n"
+			 "Content-Length: %d\r\n\r\n%s" % (len(body), body))
+		except socket.error:
+			pass
+		sock.close()
+
+describe("lines_in", "counter", "Lines received, by command.", "command")
+describe("lines_out", "counter", "Lines sent, by command.", "command")
+describe("bytes_in", "counter", "Bytes received, by connection kind.", "kind")
+describe("bytes_out", "counter", "Bytes sent, by connection kind.", "kind")
+describe("handler_seconds", "histogram",
+ "Time spent in command handlers, by command.", "command")
+describe("loop_seconds", "histogram",
+ "Time spent working in each event loop iteration.")
+describe("gc_seconds", "histogram",
+ "Time spent in collections run every GC_INTERVAL seconds.")
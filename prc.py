@@ -1,32 +1,91 @@
 #!/usr/bin/env python
 
+import asyncloop
+import casemap
 import config
 import connections
+import eventloop
+import gc
 import log
-from time import sleep
+import message
+import metrics
+import os
+import socket
+import time
 from sys import argv
 
 class PRCGateway ():
-	def __init__ (self, logger):
+	def __init__ (self, logger, conf, worker = 0, links = []):
 		self.logger = logger
-		self.conf = config.Main(argv[1], self.logger)
+		self.conf = conf
+		log_file = self.conf.LOG_FILE
+		if log_file and worker:
+			# each worker rotates a file of its own; sharing one, they
+			# would rename it from under each other
+			log_file = "%s.worker%d" % (log_file, worker)
+		self.logger.start(log_file, *self.conf.LOG_ROTATE)
+		casemap.configure(self.conf.CASEMAPPING)
+		if self.conf.RUNTIME == "asyncore":
+			self.events = asyncloop.AsyncoreLoop(self.logger)
+		else:
+			self.events = eventloop.EventLoop(self.logger)
 		self.local = connections.LocalConnections(
 		 self.conf.NAME,
 		 self.conf.LOCAL_BIND,
 		 self.conf.OPERATOR,
 		 self.conf.MOTD,
+		 self.conf.SENDQ_CLIENT,
+		 self.conf.LINELEN_CLIENT,
+		 self.conf.TAP_BACKLOG,
+		 self.conf.PING_INTERVAL,
+		 self.conf.PING_TIMEOUT,
+		 self.conf.WORKERS > 1,
+		 self.conf.PROFILE_DIR,
+		 self.events,
 		 self.logger)
 		self.remote = connections.RemoteConnections(
 		 self.conf.NETWORK,
 		 self.conf.BOOTSTRAP,
 		 self.conf.REMOTE_BIND,
 		 self.conf.HOSTNAME if self.conf.HOSTNAME else None,
+		 self.conf.SENDQ_SERVER,
+		 self.conf.LINELEN_SERVER,
+		 self.conf.CONNECT_TIMEOUT,
+		 self.conf.CONNECT_MAX,
+		 self.conf.BOOTSTRAP_RACE,
+		 self.conf.PING_INTERVAL,
+		 self.conf.PING_TIMEOUT,
+		 self.conf.LINK_ZLIB,
+		 worker,
+		 self.events,
 		 self.logger)
+		for index, link in links:
+			self.remote.add_worker(link, index)
+		if self.conf.GC_THRESHOLD:
+			gc.set_threshold(*self.conf.GC_THRESHOLD)
+		if self.conf.GC_INTERVAL:
+			self.events.call_later(self.conf.GC_INTERVAL, self.collect)
+		if self.conf.METRICS_BIND:
+			# workers each answer on their own port, counting up
+			self.metrics = metrics.Endpoint((self.conf.METRICS_BIND[0],
+			 self.conf.METRICS_BIND[1] + worker), self.events, self.logger)
+
+	def collect (self):
+		"""a full collection between loop iterations rather than whenever
+		allocations happen to trigger one"""
+		start = time.time()
+		found = gc.collect()
+		metrics.observe("gc_seconds", None, time.time() - start)
+		self.logger.log("DEBUG", "gc: %d unreachable objects", found)
+		self.events.call_later(self.conf.GC_INTERVAL, self.collect)
 
 	def loop (self):
-		self.local.loop()
-		self.remote.loop()
-		sleep(.1)
+		# sleep until a socket is ready or a timer is due
+		self.events.run_once()
+		self.local.reap()
+		self.remote.reap()
+		connections.flush_pending()
+		metrics.observe("loop_seconds", None, time.time() - self.events.woke)
 
 	def run (self):
 		try:
@@ -34,9 +93,33 @@ class PRCGateway ():
 				self.loop()
 		except KeyboardInterrupt:
 			[listener.close() for listener in self.local.listeners]
-			self.remote.sock.close()
+			if self.remote.sock:
+				self.remote.sock.close()
+				self.remote.hostcache.save()
+			self.logger.stop()
 
 if len(argv) < 2:
 	exit("syntax: python %s (config filename)" % argv[0])
 
-gateway = PRCGateway(log.logger("ERROR")).run()
+def spawn_workers (count):
+	"""forks count - 1 more gateway processes, each linked to this one
+	(worker 0) by a socketpair; returns this process' worker index and
+	its links as (index, socket) pairs"""
+	pairs = [socket.socketpair() for i in xrange(count - 1)]
+	for index, pair in enumerate(pairs, 1):
+		if os.fork() == 0:
+			# event ids have to differ between the workers
+			message.ids = message.Ids()
+			for other in pairs:
+				other[0].close()
+				if other is not pair:
+					other[1].close()
+			return index, [(0, pair[1])]
+	for pair in pairs:
+		pair[1].close()
+	return 0, [(index, pair[0]) for index, pair in enumerate(pairs, 1)]
+
+logger = log.logger("ERROR")
+conf = config.Main(argv[1], logger)
+worker, links = spawn_workers(conf.WORKERS)
+gateway = PRCGateway(logger, conf, worker, links).run()
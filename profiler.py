@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import cProfile
+import os
+import pstats
+import StringIO
+import sys
+import thread
+import threading
+import time
+
+class Sampler (threading.Thread):
+	"""low-overhead statistical profiler
+
+	a background thread looks at the main thread's stack every interval
+	seconds and counts the functions on it, so the gateway itself runs
+	unchanged; counts are per sample, not per call"""
+	def __init__ (self, interval = 0.005):
+		threading.Thread.__init__(self, name = "profiler")
+		self.daemon = True
+		self.interval = interval
+		self.target = thread.get_ident()
+		self.running = True
+		self.samples = 0
+		# "file:line(function)" -> samples with it on top of the stack
+		self.own = {}
+		# the same, for samples with it anywhere on the stack
+		self.total = {}
+		# ";"-joined stacks, outermost first -> samples
+		self.stacks = {}
+
+	def run (self):
+		while self.running:
+			time.sleep(self.interval)
+			frame = sys._current_frames().get(self.target)
+			if frame is None:
+				continue
+			stack = []
+			while frame is not None:
+				code = frame.f_code
+				stack.append("%s:%d(%s)" % (os.path.basename(code.co_filename),
+				 code.co_firstlineno, code.co_name))
+				frame = frame.f_back
+			self.samples += 1
+			self.own[stack[0]] = self.own.get(stack[0], 0) + 1
+			for name in set(stack):
+				self.total[name] = self.total.get(name, 0) + 1
+			key = ";".join(reversed(stack))
+			self.stacks[key] = self.stacks.get(key, 0) + 1
+
+	def stop (self):
+		self.running = False
+		self.join()
+
+	def write (self, filename):
+		"""writes the stacks in collapsed format, which flamegraph tools
+		read"""
+		with open(filename, "w") as f:
+			for stack, count in sorted(self.stacks.iteritems()):
+				f.write("%s %d\n" % (stack, count))
+
+	def top (self, count):
+		lines = ["%d samples, %.1f ms apart; own%% total%% function" %
+		 (self.samples, self.interval * 1e3)]
+		for name, own in sorted(self.own.iteritems(), key = lambda i: -i[1])[
+		 :count]:
+			lines.append("%5.1f %5.1f %s" % (100.0 * own / self.samples,
+			 100.0 * self.total[name] / self.samples, name))
+		return lines
+
+class Session ():
+	"""one profiling run, started and stopped from the event loop"""
+	def __init__ (self, mode, directory):
+		self.mode = mode
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.filename = os.path.join(directory, "%s-%s-%d.%s" % (mode,
+		 time.strftime("%Y%m%d-%H%M%S"), os.getpid(),
+		 "prof" if mode == "cprofile" else "txt"))
+		self.started = time.time()
+		if mode == "cprofile":
+			self.profile = cProfile.Profile()
+			self.profile.enable()
+		else:
+			self.profile = Sampler()
+			self.profile.start()
+
+	def stop (self, count):
+		"""stops profiling, writes the file and returns a top-count summary
+		of where the time went"""
+		if self.mode == "cprofile":
+			self.profile.disable()
+			self.profile.dump_stats(self.filename)
+			out = StringIO.StringIO()
+			stats = pstats.Stats(self.profile, stream = out)
+			stats.sort_stats("tottime").print_stats(count)
+			# keep the table, not pstats' preamble
+			lines = out.getvalue().split("\n")
+			start = [i for i, l in enumerate(lines) if "ncalls" in l]
+			lines = [l.strip() for l in lines[start[0] if start else 0:]
+			 if l.strip()]
+		else:
+			self.profile.stop()
+			self.profile.write(self.filename)
+			lines = self.profile.top(count)
+		return ["%s profile over %.1f s written to %s" % (self.mode,
+		 time.time() - self.started, self.filename)] + lines
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import socket
+import threading
+from collections import deque
+from errno import EAGAIN, EWOULDBLOCK
+
+def numeric (host):
+	"""whether host is an IPv4 address, which needs no lookup"""
+	try:
+		socket.inet_pton(socket.AF_INET, host)
+	except (socket.error, ValueError):
+		return False
+	return True
+
+class Resolver ():
+	"""looks up host names away from the event loop
+
+	getaddrinfo blocks for as long as DNS takes (or forever, for names
+	like .onion that never resolve), so each lookup gets a daemon thread
+	of its own and one name that hangs holds up no other; a name already
+	being looked up is not looked up again, which keeps it to a thread
+	per stuck name however often it is retried. answers come back
+	through a deque, and a byte on a socketpair the loop watches wakes it
+	up to run the callbacks"""
+	def __init__ (self, events, logger):
+		self.events = events
+		self.logger = logger
+		# (host, port) -> callbacks waiting for that lookup; only the loop
+		# touches it
+		self.waiting = {}
+		# ((host, port), address, error) answers not yet handed out
+		self.answers = deque()
+		self.wake, self.waker = socket.socketpair()
+		self.wake.setblocking(0)
+		self.events.register(self.wake, self.deliver)
+
+	def resolve (self, host, port, callback):
+		"""calls callback((ip, port), None) or callback(None, reason) from
+		the loop once host is looked up"""
+		key = (host, port)
+		if key in self.waiting:
+			self.waiting[key].append(callback)
+			return
+		self.waiting[key] = [callback]
+		thread = threading.Thread(target = self.lookup, args = (key,),
+		 name = "resolver %s" % host)
+		thread.daemon = True
+		thread.start()
+
+	def lookup (self, key):
+		try:
+			address = socket.getaddrinfo(key[0], key[1], socket.AF_INET,
+			 socket.SOCK_STREAM)[0][4]
+			error = None
+		except socket.error as e:
+			address = None
+			error = e.strerror or str(e)
+		self.answers.append((key, address, error))
+		try:
+			self.waker.send("\0")
+		except socket.error:
+			pass
+
+	def deliver (self):
+		try:
+			while self.wake.recv(4096):
+				pass
+		except socket.error as e:
+			if e.errno not in (EAGAIN, EWOULDBLOCK):
+				self.logger.log("WARN", "resolver wakeup failed: %s", e)
+		while self.answers:
+			key, address, error = self.answers.popleft()
+			for callback in self.waiting.pop(key, ()):
+				callback(address, error)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import math
+import time
+
+def round_up (seconds):
+	"""seconds rounded up to a whole millisecond, with half of one more so
+	pollers that truncate their timeout to milliseconds (poll, epoll)
+	still get the rounded-up value; truncated, the loop wakes just before
+	the timer is due and spins until it is"""
+	return (math.ceil(seconds * 1000) + 0.5) / 1000
+
+class Timer (object):
+	"""a callback due at a point in time; cancel() before it fires to
+	drop it"""
+	__slots__ = ("when", "callback", "args", "cancelled")
+
+	def __init__ (self, when, callback, args):
+		self.when = when
+		self.callback = callback
+		self.args = args
+		self.cancelled = False
+
+	def cancel (self):
+		# the wheel holds on to the timer until its slot comes round, but
+		# not to whatever the callback refers to
+		self.cancelled = True
+		self.callback = self.args = None
+
+class TimerWheel ():
+	"""hashed timer wheel
+
+	time is cut into ticks of resolution seconds, and a timer is kept in
+	the slot of the tick it is due in (modulo the size of the wheel), so
+	adding and cancelling are O(1) and each tick only looks at the timers
+	hashed to it, however many connections there are. timers fire at the
+	end of their tick, so up to resolution seconds late; ones further out
+	than one turn of the wheel just stay in their slot for more turns"""
+	def __init__ (self, resolution = 0.25, size = 1024):
+		self.resolution = resolution
+		self.size = size
+		self.slots = [[] for i in xrange(size)]
+		# the next tick to be processed
+		self.tick = int(time.time() / resolution)
+		self.count = 0
+		# the earliest tick with a timer that may be due, or None when
+		# that has to be looked for again
+		self.due = None
+
+	def call_later (self, delay, callback, *args):
+		"""runs callback(*args) after delay seconds"""
+		timer = Timer(time.time() + delay, callback, args)
+		self.add(timer)
+		return timer
+
+	def add (self, timer):
+		tick = max(int(timer.when / self.resolution), self.tick)
+		self.slots[tick % self.size].append(timer)
+		self.count += 1
+		if self.due is not None and tick < self.due:
+			self.due = tick
+
+	def timeout (self, now):
+		"""seconds until the earliest timer fires, or None if no timers are
+		set"""
+		if not self.count:
+			return None
+		if self.due is None:
+			self.due = self.next_due()
+		return max(0, (self.due + 1) * self.resolution - now)
+
+	def next_due (self):
+		# the first slot holding a live timer for this turn of the wheel;
+		# with none, wake up once a turn for the ones further out
+		for tick in xrange(self.tick, self.tick + self.size):
+			for timer in self.slots[tick % self.size]:
+				if (not timer.cancelled and
+				 int(timer.when / self.resolution) <= tick):
+					return tick
+		return self.tick + self.size - 1
+
+	def run (self, now):
+		"""fires every timer whose tick has passed"""
+		last = int(now / self.resolution)
+		if last > self.tick:
+			self.due = None
+		if not self.count:
+			self.tick = max(self.tick, last)
+			return
+		while self.tick < last:
+			index = self.tick % self.size
+			slot = self.slots[index]
+			self.tick += 1
+			if not slot:
+				continue
+			# callbacks may add timers, which go into slots from self.tick on
+			self.slots[index] = []
+			for timer in slot:
+				if timer.cancelled:
+					self.count -= 1
+				elif timer.when > now:
+					# due on a later turn of the wheel
+					self.slots[index].append(timer)
+				else:
+					self.count -= 1
+					timer.callback(*timer.args)
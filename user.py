@@ -26,38 +26,87 @@
 # those of the authors and should not be interpreted as representing official
 # policies, either expressed or implied, of the FreeBSD Project.
 
+import casemap
 import log
+import message
+import metrics
 
-class User ():
-	def __init__ (self, socket, address, local, nick, ident, logger,
-	 gecos = "", localconn = None):
-		self.sock = socket
-		self.localconn = localconn
-		self.address = address
+# the neighbours of every user that has none; never written to
+nobody = {}
+
+class User (object):
+	"""a user on this gateway or behind a server link
+
+	there is one for every user on the network, so it keeps to slots, its
+	nick, ident and host are interned (remote users mostly share a few
+	hosts), and it logs through its connection rather than holding a
+	logger"""
+	__slots__ = ("conn", "local", "nick", "key", "ident", "host", "gecos",
+	 "hostmask", "hostmask_lower", "channels", "neighbours", "away",
+	 "isoper")
+
+	def __init__ (self, conn, host, local, nick, ident, gecos = ""):
+		# the LocalConnection of a local user, else the link it is behind
+		self.conn = conn
+		self.host = intern(host)
 		self.local = local
-		self.nick = nick
-		self.ident = ident
+		self.nick = intern(nick)
+		# the folded nick, which users and Channel.nicks are keyed by
+		self.key = intern(casemap.fold(nick))
+		self.ident = intern(ident)
 		self.gecos = gecos
-		self.logger = logger
-		self.host = address
+		self.hostmask = None
+		self.hostmask_lower = None
+		# Channel.key of each channel the user is in
 		self.channels = []
+		# local users sharing at least one channel with this user, mapped
+		# to the number of channels they share
+		self.neighbours = nobody
 		self.away = None
 		self.isoper = False
-		self.logger.log_line("DEBUG", "user %s created" % self.nick)
+		self.conn.logger.log("DEBUG", "user %s created", self.nick)
 
 	def full_hostmask (self):
-		return "%s!%s@%s" % (self.nick, self.ident, self.address[0])
+		if self.hostmask is None:
+			self.hostmask = "%s!%s@%s" % (self.nick, self.ident, self.host)
+			self.hostmask_lower = casemap.fold(self.hostmask)
+		return self.hostmask
+
+	def lower_hostmask (self):
+		if self.hostmask is None:
+			self.full_hostmask()
+		return self.hostmask_lower
+
+	def set_nick (self, nick):
+		self.nick = intern(nick)
+		self.key = intern(casemap.fold(nick))
+		self.hostmask = None
+
+	def set_ident (self, ident):
+		self.ident = intern(ident)
+		self.hostmask = None
+
+	def add_neighbour (self, user):
+		if self.neighbours is nobody:
+			self.neighbours = {}
+		self.neighbours[user] = self.neighbours.get(user, 0) + 1
+
+	def remove_neighbour (self, user):
+		count = self.neighbours.get(user, 0)
+		if count > 1:
+			self.neighbours[user] = count - 1
+		elif count:
+			del self.neighbours[user]
+			if not self.neighbours:
+				self.neighbours = nobody
 
 	def send (self, line):
-		self.logger.log_line("DEBUG",
-		 "\x1b[31;1m->\x1b[0;1m  to  %s\x1b[0m %s" % (self.nick, line))
-		#try:
-		self.sock.send("%s\r\n" % line)
-		#except:
-		#	self.logger.log_line("DEBUG", "sending data to a dead sock %s" %
-		#	 self.nick)
-
-	def __del__ (self):
-		self.logger.log_line("DEBUG", "user %s deleted" % self.nick)
-		for channel in self.channels[:]:
-			channel.quit_user(self)
+		if self.conn.logger.debug:
+			self.conn.logger.log("DEBUG",
+			 "\x1b[31;1m->\x1b[0;1m  to  %s\x1b[0m %s", self.nick, line)
+		if not self.local:
+			# goes out (and is counted) with the rest of the link's output
+			self.conn.send(message.tag(line) if self.conn.tagged else line)
+			return
+		metrics.count_line("lines_out", line)
+		self.conn.write("%s\r\n" % line)